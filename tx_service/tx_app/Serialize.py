@@ -18,38 +18,48 @@ def accounts(accounts):
     return account_data
 
 
-def holidays(holidays):
-    holiday_data = []
+def holidays(holidays, summaries=None):
+    years = {}
     for holiday in holidays:
         year = holiday.start_date.year
-        if year not in [hol['year'] for hol in holiday_data]:
-            holiday_data.append({'year': year, 'holidays': []})
+        if year not in years:
+            years[year] = {'year': year, 'holidays': []}
 
-        holiday_data[[hol['year'] for hol in holiday_data].index(year)]['holidays'].append(holiday.serialize_with_financial_summary())
+        years[year]['holidays'].append(
+            holiday.serialize_with_financial_summary(summaries[holiday.id] if summaries is not None else None))
 
+    return list(years.values())
 
-    return holiday_data
-
-def tags(tags, sub_tags, rules, categories):
+def tags(tree):
     data = {
         'tags': [],
-        'categories': [category.serialize() for category in categories]
+        'categories': [category.serialize() for category in tree.categories]
     }
 
-    for tag in tags:
+    for tag in tree.tags:
         tag_data = tag.serialize()
 
-        tag_data['childTags'] = [sub_tag.serialize() for sub_tag in sub_tags if sub_tag.parent.id == tag.id]
+        tag_data['childTags'] = [sub_tag.serialize() for sub_tag in tree.children[tag.id]]
         for childTag in tag_data['childTags']:
-            childTag['rules'] = [rule.serialize() for rule in rules if rule.tag.id == childTag['id']]
+            childTag['rules'] = [rule.serialize() for rule in tree.rules.get(childTag['id'], [])]
 
         data['tags'].append(tag_data)
-        tag_data['rules'] = [rule.serialize() for rule in rules if rule.tag.id == tag.id]
+        tag_data['rules'] = [rule.serialize() for rule in tree.rules.get(tag.id, [])]
+
+    return data
+
+
+def tag_tree(tree):
+    data = []
+    for tag in tree.tags:
+        tag_data = tag.serialize()
+        tag_data['childTags'] = [sub_tag.serialize() for sub_tag in tree.children[tag.id]]
+        data.append(tag_data)
 
     return data
 
 
-def transactions(accounts, transactions, institutions, links, tags, sub_tags):
+def transactions(accounts, transactions, institutions, links, tree):
     data = {
         'accounts': [],
         'links': [],
@@ -67,13 +77,16 @@ def transactions(accounts, transactions, institutions, links, tags, sub_tags):
     for link in links:
         data['links'].append(link.serialize())
 
-    for tag in tags:
-        tag_data = tag.serialize()
-        tag_data['childTags'] = [sub_tag.serialize() for sub_tag in sub_tags if sub_tag.parent.id == tag.id]
-        data['tags'].append(tag_data)
+    data['tags'] = tag_tree(tree)
 
     return data
 
 
+def transaction(transaction):
+    transaction_data = transaction.serialize()
+    transaction_data['accountId'] = transaction.account_id
+    return transaction_data
+
+
 def rules(rules):
     return {"rules": [rule.serialize() for rule in rules]}
@@ -1,46 +1,128 @@
-import django.db.utils
+import datetime
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 
+from django.db.models import Q
+
+from tx_app import changes, reports
 from tx_app.models import *
 
+LINK_WINDOW_DAYS = 3
+LINK_AMOUNT_TOLERANCE = 0.0
+AMOUNT_EPSILON = 0.005
+
+LinkCandidate = namedtuple('LinkCandidate', ['id', 'account_id', 'booking_date', 'amount', 'reference'])
+LinkMatch = namedtuple('LinkMatch', ['from_transaction', 'to_transaction', 'confidence'])
+
 
-def find_links(user):
+def find_links(user, window_days=LINK_WINDOW_DAYS, amount_tolerance=LINK_AMOUNT_TOLERANCE):
     transactions = Transaction.objects.filter(account__user=user)
+    linked_ids = linked_transaction_ids(user)
+
+    candidates = [candidate for candidate in load_candidates(transactions) if candidate.id not in linked_ids]
+    matches = match_candidates(candidates, window_days, amount_tolerance)
+
+    return create_links(user, matches)
+
+
+def find_links_for(user, transaction_ids, window_days=LINK_WINDOW_DAYS, amount_tolerance=LINK_AMOUNT_TOLERANCE):
+    if not transaction_ids:
+        return []
+
+    new_transactions = Transaction.objects.filter(account__user=user, id__in=transaction_ids)
+    booking_dates = {booking_date + datetime.timedelta(days=offset)
+                     for booking_date in set(new_transactions.values_list('booking_date', flat=True))
+                     for offset in range(-window_days, window_days + 1)}
+
+    transactions = (Transaction.objects
+                    .filter(account__user=user, booking_date__in=booking_dates)
+                    .exclude(id__in=TransactionLink.objects.values('from_transaction_id'))
+                    .exclude(id__in=TransactionLink.objects.values('to_transaction_id')))
+
+    matches = match_candidates(load_candidates(transactions), window_days, amount_tolerance, required_ids=set(transaction_ids))
+
+    return create_links(user, matches)
+
+
+def load_candidates(transactions):
+    return [LinkCandidate(*row) for row in
+            transactions.values_list('id', 'account_id', 'booking_date', 'amount', 'reference').order_by('id')]
+
+
+def linked_transaction_ids(user):
+    links = (TransactionLink.objects
+             .filter(Q(from_transaction__account__user=user) | Q(to_transaction__account__user=user))
+             .values_list('from_transaction_id', 'to_transaction_id'))
+
+    return {transaction_id for link in links for transaction_id in link}
+
+
+def match_confidence(from_transaction, to_transaction, window_days, amount_tolerance):
+    days_apart = abs((to_transaction.booking_date - from_transaction.booking_date).days)
+    date_score = 1 - days_apart / (window_days + 1)
+
+    amount_difference = abs(to_transaction.amount + from_transaction.amount)
+    amount_score = 1 - amount_difference / (2 * amount_tolerance) if amount_tolerance else 1
+
+    return round(date_score * max(amount_score, 0), 3)
+
+
+def match_candidates(candidates, window_days=LINK_WINDOW_DAYS, amount_tolerance=LINK_AMOUNT_TOLERANCE, required_ids=None):
+    # Incoming rows are bucketed by amount and each bucket is sorted by date,
+    # so every outgoing row bisects to the amounts inside its tolerance and
+    # then to the dates inside its window, visiting only rows it can match.
+    incoming = {}
+    for candidate in sorted((candidate for candidate in candidates if candidate.amount > 0),
+                            key=lambda candidate: (candidate.booking_date, candidate.id)):
+        incoming.setdefault(candidate.amount, []).append(candidate)
+    amounts = sorted(incoming)
+    dates = {amount: [candidate.booking_date for candidate in bucket] for amount, bucket in incoming.items()}
+    window = datetime.timedelta(days=window_days)
 
-    for transaction in transactions:
-        linked, link = find_link(transaction, transactions)
-        if linked:
-            print(f"Found Link: {link.from_transaction.reference} : {link.from_transaction.amount} -> {link.to_transaction.reference} : {link.to_transaction.amount}")
+    proposals = []
+    for from_transaction in (candidate for candidate in candidates if candidate.amount < 0):
+        lowest = -from_transaction.amount - amount_tolerance - AMOUNT_EPSILON
+        highest = -from_transaction.amount + amount_tolerance + AMOUNT_EPSILON
 
+        for amount in amounts[bisect_left(amounts, lowest):bisect_right(amounts, highest)]:
+            bucket = incoming[amount]
+            first = bisect_left(dates[amount], from_transaction.booking_date - window)
+            last = bisect_right(dates[amount], from_transaction.booking_date + window)
 
-def find_link(transaction_a, transactions):
-    NO_LINK_CREATED = False, None
+            for to_transaction in bucket[first:last]:
+                if to_transaction.account_id == from_transaction.account_id:
+                    continue
+                if required_ids is not None and from_transaction.id not in required_ids and to_transaction.id not in required_ids:
+                    continue
 
-    transactions = transactions.exclude(account=transaction_a.account).filter(booking_date=transaction_a.booking_date)
+                confidence = match_confidence(from_transaction, to_transaction, window_days, amount_tolerance)
+                proposals.append(LinkMatch(from_transaction, to_transaction, confidence))
 
-    for transaction_b in transactions:
-        if has_link(transaction_a, transaction_b):
-            from_transaction = transaction_a if transaction_a.amount < 0 < transaction_b.amount else transaction_b
-            to_transaction = transaction_a if transaction_a.amount > 0 > transaction_b.amount else transaction_b
+    proposals.sort(key=lambda match: (-match.confidence, match.from_transaction.id, match.to_transaction.id))
 
-            link = TransactionLink()
-            link.from_transaction = from_transaction
-            link.to_transaction = to_transaction
+    matched_ids = set()
+    matches = []
+    for match in proposals:
+        if match.from_transaction.id in matched_ids or match.to_transaction.id in matched_ids:
+            continue
+        matched_ids.update((match.from_transaction.id, match.to_transaction.id))
+        matches.append(match)
 
-            try:
-                link.save()
-            except django.db.utils.IntegrityError:
-                return NO_LINK_CREATED
+    return matches
 
-            return True, link
 
-    return NO_LINK_CREATED
+def create_links(user, matches):
+    for from_transaction, to_transaction, confidence in matches:
+        print(f"Found Link: {from_transaction.reference} : {from_transaction.amount} -> {to_transaction.reference} : {to_transaction.amount} ({confidence})")
 
+    links = [TransactionLink(from_transaction_id=from_transaction.id, to_transaction_id=to_transaction.id, confidence=confidence)
+             for from_transaction, to_transaction, confidence in matches]
 
-def has_link(transaction_a, transaction_b):
-    if not (transaction_a.is_unlinked() and transaction_b.is_unlinked()):
-        return False
+    TransactionLink.objects.bulk_create(links, ignore_conflicts=True)
 
-    if transaction_a.amount + transaction_b.amount == 0:
-        return True
+    reports.refresh_months(user.id, {(transaction.booking_date.year, transaction.booking_date.month)
+                                     for match in matches for transaction in match[:2]})
+    if links:
+        changes.record(user.id, ChangeEvent.LINK, [link.from_transaction_id for link in links])
 
-    return False
+    return links
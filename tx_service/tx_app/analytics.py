@@ -0,0 +1,230 @@
+import datetime
+from dataclasses import dataclass, fields
+
+import numpy as np
+from django.db.models import BooleanField, Case, Value, When
+from django.db.models.functions import Coalesce
+
+from tx_app import holiday_summary, reports, tag_tree
+from tx_app.models import Transaction
+
+# Sentinel for null foreign keys, ids are always positive.
+MISSING = -1
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+DEFAULT_PERCENTILES = (50, 90)
+
+
+@dataclass
+class TransactionColumns:
+    ids: np.ndarray
+    user_ids: np.ndarray
+    amounts: np.ndarray
+    dates: np.ndarray
+    tag_ids: np.ndarray
+    parent_tag_ids: np.ndarray
+    category_ids: np.ndarray
+    is_savings: np.ndarray
+    holiday_ids: np.ndarray
+    unlinked: np.ndarray
+
+    @classmethod
+    def load(cls, transactions):
+        rows = list(transactions
+                    .annotate(column_category_id=Coalesce('tag__category_id', 'tag__parent__category_id'),
+                              column_is_savings=Case(When(account__type__code='SAVINGS', then=Value(True)),
+                                                     default=Value(False), output_field=BooleanField()),
+                              column_unlinked=Case(When(from_transaction__isnull=True, to_transaction__isnull=True, then=Value(True)),
+                                                   default=Value(False), output_field=BooleanField()))
+                    .values_list('id', 'account__user_id', 'amount', 'booking_date', 'tag_id', 'tag__parent_id',
+                                 'column_category_id', 'column_is_savings', 'holiday_id', 'column_unlinked')
+                    .order_by('booking_date', 'id'))
+        columns = list(zip(*rows)) or [()] * 10
+
+        return cls(
+            ids=id_column(columns[0]),
+            user_ids=id_column(columns[1]),
+            amounts=np.array(columns[2], dtype=np.float64),
+            dates=np.array([booking_date.toordinal() for booking_date in columns[3]], dtype=np.int64),
+            tag_ids=id_column(columns[4]),
+            parent_tag_ids=id_column(columns[5]),
+            category_ids=id_column(columns[6]),
+            is_savings=np.array(columns[7], dtype=bool),
+            holiday_ids=id_column(columns[8]),
+            unlinked=np.array(columns[9], dtype=bool),
+        )
+
+    @classmethod
+    def for_user(cls, user):
+        return cls.load(Transaction.objects.filter(account__user=user))
+
+    def where(self, mask):
+        return TransactionColumns(**{column.name: getattr(self, column.name)[mask] for column in fields(self)})
+
+    @property
+    def years(self):
+        return self.days.astype('datetime64[Y]').astype(np.int64) + 1970
+
+    @property
+    def months(self):
+        return self.days.astype('datetime64[M]').astype(np.int64) % 12 + 1
+
+    @property
+    def month_index(self):
+        # Months since 1970-01, so consecutive months are consecutive integers.
+        return self.days.astype('datetime64[M]').astype(np.int64)
+
+    @property
+    def days(self):
+        return (self.dates - EPOCH_ORDINAL).astype('datetime64[D]')
+
+    @property
+    def top_tag_ids(self):
+        return np.where(self.parent_tag_ids != MISSING, self.parent_tag_ids, self.tag_ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def id_column(values):
+    return np.array([MISSING if value is None else value for value in values], dtype=np.int64)
+
+
+def group_by(*keys):
+    if not len(keys[0]):
+        return np.empty((0, len(keys)), dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    groups, inverse = np.unique(np.column_stack(keys), axis=0, return_inverse=True)
+    return groups, inverse.ravel()
+
+
+def grouped_sum(values, inverse, size):
+    return np.bincount(inverse, weights=values, minlength=size)
+
+
+def grouped_count(inverse, size, mask=None):
+    return np.bincount(inverse, weights=mask, minlength=size).astype(np.int64)
+
+
+def grouped_percentiles(values, inverse, size, percentiles):
+    # Sort by group then value, and interpolate linearly inside each group's
+    # slice the same way np.percentile does, for every group at once.
+    order = np.lexsort((values, inverse))
+    sorted_values = values[order]
+    counts = np.bincount(inverse, minlength=size)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    result = np.full((size, len(percentiles)), np.nan)
+    present = counts > 0
+    for column, percentile in enumerate(percentiles):
+        position = (counts[present] - 1) * percentile / 100
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        low_values = sorted_values[starts[present] + lower]
+        high_values = sorted_values[starts[present] + upper]
+        result[present, column] = low_values + (high_values - low_values) * (position - lower)
+
+    return result
+
+
+def tag_statistics(columns, percentiles=DEFAULT_PERCENTILES, top_level=False):
+    tag_ids = columns.top_tag_ids if top_level else columns.tag_ids
+    groups, inverse = group_by(tag_ids)
+    size = len(groups)
+
+    totals = grouped_sum(columns.amounts, inverse, size)
+    counts = grouped_count(inverse, size)
+    values = grouped_percentiles(columns.amounts, inverse, size, percentiles)
+
+    return {
+        (None if tag_id == MISSING else int(tag_id)): {
+            "total": float(totals[index]),
+            "count": int(counts[index]),
+            "percentiles": {percentile: float(values[index, column]) for column, percentile in enumerate(percentiles)},
+        }
+        for index, (tag_id,) in enumerate(groups)
+    }
+
+
+def tag_time_series(columns, top_level=False):
+    # Returns the tag ids, the first month index and a (tags x months) matrix
+    # of monthly totals, with months that have no spend filled with zeros.
+    tag_ids = columns.top_tag_ids if top_level else columns.tag_ids
+    if not len(columns):
+        return np.empty(0, dtype=np.int64), 0, np.zeros((0, 0))
+
+    month_index = columns.month_index
+    first_month = int(month_index.min())
+    months = int(month_index.max()) - first_month + 1
+
+    tags, tag_positions = np.unique(tag_ids, return_inverse=True)
+    cells = tag_positions * months + (month_index - first_month)
+    series = np.bincount(cells, weights=columns.amounts, minlength=len(tags) * months).reshape(len(tags), months)
+
+    return tags, first_month, series
+
+
+def rolling_average(series, window):
+    # Trailing mean over the last `window` months, shorter at the start.
+    if window < 1:
+        raise ValueError(f"Invalid window: {window}, expected at least 1 month")
+
+    cumulative = np.cumsum(series, axis=-1)
+    shifted = np.zeros_like(cumulative)
+    shifted[..., window:] = cumulative[..., :-window]
+    periods = np.minimum(np.arange(1, series.shape[-1] + 1), window)
+    return (cumulative - shifted) / periods
+
+
+def year_over_year(series):
+    # Relative change against the same month a year earlier, nan when there
+    # is no earlier year or it had no spend.
+    change = np.full(series.shape, np.nan)
+    previous = series[..., :-12]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change[..., 12:] = np.where(previous != 0, (series[..., 12:] - previous) / np.abs(previous), np.nan)
+    return change
+
+
+def report_rows(columns):
+    groups, inverse = group_by(columns.user_ids, columns.years, columns.months, columns.tag_ids,
+                               columns.category_ids, columns.is_savings, columns.holiday_ids != MISSING)
+    size = len(groups)
+
+    totals = grouped_sum(columns.amounts, inverse, size)
+    counts = grouped_count(inverse, size)
+    unlinked_counts = grouped_count(inverse, size, mask=columns.unlinked)
+
+    return [{
+        'account__user_id': int(user_id),
+        'year': int(year),
+        'month': int(month),
+        'tag_id': None if tag_id == MISSING else int(tag_id),
+        'category_id': None if category_id == MISSING else int(category_id),
+        'is_savings': bool(is_savings),
+        'on_holiday': bool(on_holiday),
+        'total': float(totals[index]),
+        'count': int(counts[index]),
+        'unlinked_count': int(unlinked_counts[index]),
+    } for index, (user_id, year, month, tag_id, category_id, is_savings, on_holiday) in enumerate(groups)]
+
+
+def columnar_report(user, columns=None):
+    if columns is None:
+        columns = TransactionColumns.for_user(user)
+    tree = tag_tree.get(user)
+    return reports.build_report(report_rows(columns), tree.categories, tree.tags, tree.sub_tags)
+
+
+def holiday_summaries(columns, holiday_ids):
+    ordered_ids = np.unique(np.array(list(holiday_ids), dtype=np.int64))
+    columns = columns.where(np.isin(columns.holiday_ids, ordered_ids))
+    positions = np.searchsorted(ordered_ids, columns.holiday_ids)
+
+    summaries = {'total': grouped_sum(columns.amounts, positions, len(ordered_ids))}
+    for name, tag_ids in holiday_summary.bucket_tag_ids().items():
+        in_bucket = np.isin(columns.tag_ids, tag_ids)
+        summaries[name] = grouped_sum(columns.amounts * in_bucket, positions, len(ordered_ids))
+
+    return {int(holiday_id): {name: round(float(totals[index]), 2) for name, totals in summaries.items()}
+            for index, holiday_id in enumerate(ordered_ids)}
@@ -0,0 +1,124 @@
+from django.db.models import F
+from django.db.transaction import atomic
+
+from tx_app import changes, reports
+from tx_app.models import ChangeEvent, Holiday, Tag, Transaction
+
+UPDATE_BATCH_SIZE = 500
+
+UPDATED, SKIPPED, NOT_FOUND, FORBIDDEN = 'updated', 'skipped', 'not_found', 'forbidden'
+
+
+def owned_by_other_user(resource, user):
+    return resource.user_id is not None and resource.user_id != user.id
+
+
+def apply_updates(user, transaction_updates):
+    # Everything is loaded with one id__in query per model and validated in
+    # memory. Either every update is applied in one bulk UPDATE or, if any
+    # item fails, none are, and the results say which items were at fault.
+    transactions = (Transaction.objects
+                    .filter(id__in={update['transactionId'] for update in transaction_updates})
+                    .annotate(owner_id=F('account__user_id'))
+                    .in_bulk())
+    tags = Tag.objects.in_bulk({update['tagId'] for update in transaction_updates if update.get('tagId') is not None})
+    holidays = Holiday.objects.in_bulk({update['holidayId'] for update in transaction_updates
+                                        if update.get('holidayId') is not None})
+
+    results = []
+    updated = {}
+    for update in transaction_updates:
+        transaction_id = update['transactionId']
+        result = {"transactionId": transaction_id, "status": UPDATED}
+        results.append(result)
+
+        transaction = transactions.get(transaction_id)
+        if transaction is None:
+            result.update(status=NOT_FOUND, error=f"Transaction {transaction_id} does not exist")
+            continue
+        if transaction.owner_id != user.id:
+            result.update(status=FORBIDDEN, error=f"Transaction {transaction_id} does not belong to user")
+            continue
+
+        if 'tagId' in update:
+            tag_id = update['tagId']
+            if tag_id is not None and tag_id not in tags:
+                result.update(status=NOT_FOUND, error=f"Tag {tag_id} does not exist")
+                continue
+            if tag_id is not None and owned_by_other_user(tags[tag_id], user):
+                result.update(status=FORBIDDEN, error=f"Tag {tag_id} does not belong to user")
+                continue
+            transaction.tag_id = tag_id
+            transaction.tagged_by_rule = False
+
+        if 'holidayId' in update:
+            holiday_id = update['holidayId']
+            if holiday_id is not None and holiday_id not in holidays:
+                result.update(status=NOT_FOUND, error=f"Holiday {holiday_id} does not exist")
+                continue
+            if holiday_id is not None and owned_by_other_user(holidays[holiday_id], user):
+                result.update(status=FORBIDDEN, error=f"Holiday {holiday_id} does not belong to user")
+                continue
+            transaction.holiday_id = holiday_id
+
+        updated[transaction_id] = transaction
+
+    if any(result['status'] != UPDATED for result in results):
+        for result in results:
+            if result['status'] == UPDATED:
+                result['status'] = SKIPPED
+        return False, results
+
+    with atomic():
+        Transaction.objects.bulk_update(updated.values(), ['tag', 'tagged_by_rule', 'holiday'], batch_size=UPDATE_BATCH_SIZE)
+
+    reports.refresh_months(user.id, {(transaction.booking_date.year, transaction.booking_date.month)
+                                     for transaction in updated.values()})
+    changes.record(user.id, ChangeEvent.TRANSACTION, updated.keys())
+
+    return True, results
+
+
+def holiday_months(holiday):
+    months = set()
+    year, month = holiday.start_date.year, holiday.start_date.month
+    while (year, month) <= (holiday.end_date.year, holiday.end_date.month):
+        months.add((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def assign_holiday(user, holiday, account_ids=None, tag_ids=None, currency=None, clear=False, overwrite=False):
+    window = Transaction.objects.filter(account__user=user,
+                                        booking_date__gte=holiday.start_date, booking_date__lte=holiday.end_date)
+    if account_ids:
+        window = window.filter(account_id__in=account_ids)
+    if tag_ids:
+        window = window.filter(tag_id__in=tag_ids)
+    if currency:
+        window = window.filter(currency=currency)
+
+    # Transactions already on another holiday are only moved when asked to.
+    if clear:
+        targets = window.filter(holiday=holiday)
+    elif overwrite:
+        targets = window.exclude(holiday=holiday)
+    else:
+        targets = window.filter(holiday__isnull=True)
+
+    # The ids are only needed for the change feed, the update itself is a
+    # single statement over the same filtered window.
+    with atomic():
+        current_holidays = dict(targets.values_list('id', 'holiday_id'))
+        updated = targets.update(holiday=None if clear else holiday)
+
+    if updated:
+        reports.refresh_months(user.id, holiday_months(holiday))
+        changes.record(user.id, ChangeEvent.TRANSACTION, current_holidays.keys())
+
+    return {
+        "holidayId": holiday.id,
+        "matched": window.count(),
+        "updated": updated,
+        "reassigned": 0 if clear else sum(holiday_id is not None for holiday_id in current_holidays.values()),
+    }
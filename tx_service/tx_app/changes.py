@@ -0,0 +1,85 @@
+from itertools import chain
+
+from django.db.transaction import atomic
+
+import tx_app.Serialize as serialize
+from tx_app.models import (ChangeEvent, GlobalChangeEvent, GlobalDataVersion, Tag, TagRule, Transaction, TransactionLink,
+                           UserDataVersion)
+
+CHANGE_KEYS = {
+    ChangeEvent.TRANSACTION: 'transactions',
+    ChangeEvent.LINK: 'links',
+    ChangeEvent.TAG: 'tags',
+    ChangeEvent.RULE: 'rules',
+}
+
+
+def record(user_id, kind, object_ids, deleted=False):
+    # Takes the next sequence from the user's data version, which also
+    # invalidates their cached responses. Links are keyed on their
+    # from_transaction_id, which is unique per link.
+    object_ids = set(object_ids)
+
+    with atomic(savepoint=False):
+        sequence = UserDataVersion.bump(user_id)
+        if object_ids:
+            ChangeEvent.objects.bulk_create(
+                [ChangeEvent(user_id=user_id, kind=kind, object_id=object_id, sequence=sequence, deleted=deleted)
+                 for object_id in object_ids],
+                update_conflicts=True, unique_fields=['user', 'kind', 'object_id'], update_fields=['sequence', 'deleted'])
+
+    return sequence
+
+
+def record_all(kind, object_ids, deleted=False):
+    # Global tags belong to every user. One event on the global sequence
+    # covers every feed, and bumping the global version invalidates every
+    # user's cached responses in a single write.
+    object_ids = set(object_ids)
+
+    with atomic(savepoint=False):
+        sequence = GlobalDataVersion.bump()
+        if object_ids:
+            GlobalChangeEvent.objects.bulk_create(
+                [GlobalChangeEvent(kind=kind, object_id=object_id, sequence=sequence, deleted=deleted)
+                 for object_id in object_ids],
+                update_conflicts=True, unique_fields=['kind', 'object_id'], update_fields=['sequence', 'deleted'])
+
+    return sequence
+
+
+def changes_since(user, since, global_since=0):
+    sequence, global_sequence = UserDataVersion.current_with_global(user.id)
+
+    upserts = {kind: set() for kind in CHANGE_KEYS}
+    deletes = {kind: set() for kind in CHANGE_KEYS}
+    events = chain(ChangeEvent.objects.filter(user=user, sequence__gt=since).values_list('kind', 'object_id', 'deleted'),
+                   GlobalChangeEvent.objects.filter(sequence__gt=global_since).values_list('kind', 'object_id', 'deleted'))
+    for kind, object_id, deleted in events:
+        (deletes if deleted else upserts)[kind].add(object_id)
+
+    found = {
+        ChangeEvent.TRANSACTION: {transaction.id: serialize.transaction(transaction) for transaction in
+                                  Transaction.objects.filter(account__user=user, id__in=upserts[ChangeEvent.TRANSACTION])
+                                  .select_related('tag__category', 'holiday')},
+        ChangeEvent.LINK: {link.from_transaction_id: link.serialize() for link in
+                           TransactionLink.objects.filter(from_transaction__account__user=user,
+                                                          from_transaction_id__in=upserts[ChangeEvent.LINK])
+                           .select_related('from_transaction__account__type', 'to_transaction__account__type')},
+        ChangeEvent.TAG: {tag.id: dict(tag.serialize(), parentId=tag.parent_id) for tag in
+                          Tag.objects.filter(id__in=upserts[ChangeEvent.TAG]).select_related('category')},
+        ChangeEvent.RULE: {rule.id: dict(rule.serialize(), tagId=rule.tag_id) for rule in
+                           TagRule.objects.filter(user=user, id__in=upserts[ChangeEvent.RULE])},
+    }
+
+    # Anything changed and then removed without its own delete event (a
+    # cascade, say) is reported as deleted too.
+    for kind, object_ids in upserts.items():
+        deletes[kind].update(object_ids - found[kind].keys())
+
+    return {
+        'sequence': sequence,
+        'globalSequence': global_sequence,
+        'upserts': {CHANGE_KEYS[kind]: list(objects.values()) for kind, objects in found.items()},
+        'deletes': {CHANGE_KEYS[kind]: sorted(object_ids) for kind, object_ids in deletes.items()},
+    }
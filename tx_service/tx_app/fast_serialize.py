@@ -0,0 +1,181 @@
+import datetime
+from itertools import groupby
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+import tx_app.Serialize as serialize
+from tx_app import tag_tree
+from tx_app.models import Account, Holiday, Tag, Transaction, TransactionLink
+
+# Builds the same document as Serialize.transactions straight from value
+# rows. Keys are emitted in the same order as the model serialize() methods,
+# so the encoded JSON is byte-identical.
+
+
+def account(row, today):
+    expires = row['requisition__expires']
+    account_data = {
+        'accountId': row['id'],
+        'name': row['name'],
+        'bankName': row['institution__name'],
+        'bankCode': row['institution__code'],
+        'logo': row['institution__logo_url'],
+        'balance': row['balance'],
+        'expires': expires,
+        'expired': expires <= today if expires is not None else None,
+    }
+
+    if row['colour'] is not None:
+        account_data['colour'] = row['colour']
+    return account_data
+
+
+def tag(row):
+    tag_data = {
+        "id": row['id'],
+        "name": row['name'],
+        "icon": row['icon'],
+    }
+
+    if row['category_id'] is not None:
+        tag_data["category"] = {
+            "code": row['category__code'],
+            "name": row['category__name']
+        }
+
+    return tag_data
+
+
+def holiday(row):
+    return {
+        "id": row['id'],
+        "name": row['name'],
+        "startDate": row['start_date'],
+        "endDate": row['end_date'],
+        "img": row['img_url']
+    }
+
+
+def link(row):
+    (from_transaction_id, to_transaction_id, from_account_id, from_account_type, to_account_id, to_account_type,
+     amount, booking_date, booking_date_time, reference, confidence) = row
+    return {
+        "fromTransactionId": from_transaction_id,
+        "toTransactionId": to_transaction_id,
+        "fromAccountId": from_account_id,
+        "fromAccountIsSavings": from_account_type == "SAVINGS",
+        "toAccountId": to_account_id,
+        "toAccountIsSavings": to_account_type == "SAVINGS",
+        "amount": amount,
+        "bookingDate": booking_date,
+        "bookingDateTime": booking_date_time,
+        "reference": reference,
+        "confidence": confidence,
+    }
+
+
+TAG_FIELDS = ('id', 'name', 'icon', 'parent_id', 'category_id', 'category__code', 'category__name')
+TRANSACTION_FIELDS = ('id', 'account_id', 'booking_date', 'booking_date_time', 'tag_id', 'holiday_id', 'amount',
+                      'currency', 'reference', 'transactions_code')
+
+STREAM_CHUNK_SIZE = 2000
+STREAM_BUFFER_BYTES = 64 * 1024
+
+
+def transaction(row, tags, holidays):
+    (transaction_id, account_id, booking_date, booking_date_time, tag_id, holiday_id, amount, currency,
+     reference, transactions_code) = row
+    return {
+        "transactionId": transaction_id,
+        "bookingDate": booking_date,
+        "bookingDateTime": booking_date_time,
+        "tag": tags[tag_id] if tag_id is not None else None,
+        "holiday": holidays[holiday_id] if holiday_id is not None else None,
+        "value": {
+            "amount": amount,
+            "currency": currency
+        },
+        "reference": reference,
+        "transactions_code": transactions_code
+    }
+
+
+def user_accounts(user):
+    return list(Account.objects.filter(user=user).order_by('id').values(
+        'id', 'name', 'balance', 'colour', 'institution__name', 'institution__code', 'institution__logo_url',
+        'requisition__expires'))
+
+
+def user_transactions(user):
+    return (Transaction.objects.filter(account__user=user)
+            .order_by('account_id', '-booking_date_time', '-id')
+            .values_list(*TRANSACTION_FIELDS))
+
+
+def used_tags_and_holidays(tag_ids, holiday_ids):
+    tags = {row['id']: tag(row) for row in Tag.objects.filter(id__in=tag_ids).values(*TAG_FIELDS)}
+    holidays = {row['id']: holiday(row) for row in
+                Holiday.objects.filter(id__in=holiday_ids).values('id', 'name', 'start_date', 'end_date', 'img_url')}
+    return tags, holidays
+
+
+def user_links(user):
+    return [link(row) for row in TransactionLink.objects.filter(from_transaction__account__user=user).order_by('id').values_list(
+        'from_transaction_id', 'to_transaction_id', 'from_transaction__account_id', 'from_transaction__account__type__code',
+        'to_transaction__account_id', 'to_transaction__account__type__code', 'to_transaction__amount',
+        'to_transaction__booking_date', 'to_transaction__booking_date_time', 'to_transaction__reference', 'confidence')]
+
+
+def transactions(user):
+    today = datetime.date.today()
+
+    accounts = user_accounts(user)
+    rows = list(user_transactions(user))
+    tags, holidays = used_tags_and_holidays({row[4] for row in rows if row[4] is not None},
+                                            {row[5] for row in rows if row[5] is not None})
+
+    account_transactions = {account_row['id']: [] for account_row in accounts}
+    for row in rows:
+        account_transactions[row[1]].append(transaction(row, tags, holidays))
+
+    return {
+        'accounts': [dict(account(account_row, today), transactions=account_transactions[account_row['id']])
+                     for account_row in accounts],
+        'links': user_links(user),
+        'tags': serialize.tag_tree(tag_tree.get(user)),
+    }
+
+
+def stream_transactions(user):
+    # Yields the same bytes as encoding transactions(user), reading rows
+    # through a chunked cursor so only one buffer is ever held in memory.
+    # Tags and holidays referenced by the rows are resolved with subqueries
+    # up front since the rows themselves are never all in hand.
+    encode = DjangoJSONEncoder().encode
+    today = datetime.date.today()
+
+    user_transaction_rows = Transaction.objects.filter(account__user=user)
+    tags, holidays = used_tags_and_holidays(user_transaction_rows.values('tag_id'), user_transaction_rows.values('holiday_id'))
+    rows = groupby(user_transactions(user).iterator(chunk_size=STREAM_CHUNK_SIZE), key=lambda row: row[1])
+    next_group = next(rows, None)
+
+    buffer = ['{"accounts": [']
+    size = 0
+    for index, account_row in enumerate(user_accounts(user)):
+        # Re-open the encoded account object to append its transactions.
+        buffer.append((', ' if index else '') + encode(account(account_row, today))[:-1] + ', "transactions": [')
+
+        if next_group is not None and next_group[0] == account_row['id']:
+            for position, row in enumerate(next_group[1]):
+                chunk = (', ' if position else '') + encode(transaction(row, tags, holidays))
+                buffer.append(chunk)
+                size += len(chunk)
+                if size >= STREAM_BUFFER_BYTES:
+                    yield ''.join(buffer).encode()
+                    buffer, size = [], 0
+            next_group = next(rows, None)
+
+        buffer.append(']}')
+
+    buffer.append('], "links": ' + encode(user_links(user)) + ', "tags": ' + encode(serialize.tag_tree(tag_tree.get(user))) + '}')
+    yield ''.join(buffer).encode()
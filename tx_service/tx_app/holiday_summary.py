@@ -0,0 +1,61 @@
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db.models import Q, Sum
+
+from tx_app.models import Tag, Transaction
+
+# Each bucket sums the holiday's transactions whose tag is one of `tags`,
+# or whose parent tag is `parent`, minus any tag named in `exclude`.
+DEFAULT_SUMMARY_BUCKETS = {
+    'travel': {'parent': 'Travel', 'exclude': ['Hotels']},
+    'hotels': {'tags': ['Hotels']},
+    'food': {'tags': ['Eating Out']},
+}
+
+
+def summary_buckets():
+    return getattr(settings, 'HOLIDAY_SUMMARY_BUCKETS', DEFAULT_SUMMARY_BUCKETS)
+
+
+def bucket_filter(bucket, prefix=''):
+    conditions = []
+    if 'tags' in bucket:
+        conditions.append(Q(**{f'{prefix}name__in': bucket['tags']}))
+    if 'parent' in bucket:
+        conditions.append(Q(**{f'{prefix}parent__name': bucket['parent']}))
+
+    matches = reduce(or_, conditions)
+    if 'exclude' in bucket:
+        matches &= ~Q(**{f'{prefix}name__in': bucket['exclude']})
+    return matches
+
+
+def bucket_tag_ids():
+    return {name: list(Tag.objects.filter(bucket_filter(bucket)).values_list('id', flat=True))
+            for name, bucket in summary_buckets().items()}
+
+
+def empty_summary():
+    return dict({'total': 0}, **{name: 0 for name in summary_buckets()})
+
+
+def summarise(user, holidays):
+    # One query grouped by holiday with a filtered SUM per bucket.
+    holiday_ids = [holiday.id for holiday in holidays]
+    buckets = {f'bucket_{name}': Sum('amount', filter=bucket_filter(bucket, 'tag__'))
+               for name, bucket in summary_buckets().items()}
+
+    summaries = {holiday_id: empty_summary() for holiday_id in holiday_ids}
+    for row in (Transaction.objects
+                .filter(account__user=user, holiday_id__in=holiday_ids)
+                .values('holiday_id')
+                .annotate(total=Sum('amount'), **buckets)
+                .order_by()):
+        summary = {'total': round(row['total'] or 0, 2)}
+        for name in summary_buckets():
+            summary[name] = round(row[f'bucket_{name}'] or 0, 2)
+        summaries[row['holiday_id']] = summary
+
+    return summaries
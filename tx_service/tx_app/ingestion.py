@@ -0,0 +1,186 @@
+from dataclasses import dataclass, field
+
+from django.db import DatabaseError, IntegrityError
+from django.db.transaction import atomic
+
+from tx_app import changes, reports, tagging
+from tx_app.models import ChangeEvent, Transaction
+
+INGEST_BATCH_SIZE = 500
+
+
+@dataclass
+class IngestionResult:
+    inserted: int = 0
+    duplicates: int = 0
+    rejected: int = 0
+    tagged: int = 0
+    errors: list = field(default_factory=list)
+    transaction_ids: list = field(default_factory=list)
+
+    def merge(self, other):
+        self.inserted += other.inserted
+        self.duplicates += other.duplicates
+        self.rejected += other.rejected
+        self.tagged += other.tagged
+        self.errors += other.errors
+        self.transaction_ids += other.transaction_ids
+
+    def serialize(self):
+        return {
+            "inserted": self.inserted,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "tagged": self.tagged,
+            "errors": self.errors,
+        }
+
+    def __str__(self):
+        return f"inserted: {self.inserted}, duplicates: {self.duplicates}, rejected: {self.rejected}, tagged: {self.tagged}"
+
+
+def map_transaction(account, transaction):
+    transaction_object = Transaction(
+        account=account,
+        user_id=account.user_id,
+        internal_transaction_id=transaction['internalTransactionId'],
+        booking_date=transaction['bookingDate'],
+        value_date=transaction.get('valueDate'),
+        booking_date_time=transaction['bookingDateTime'],
+        value_date_time=transaction.get('valueDateTime'),
+        amount=float(transaction['transactionAmount']['amount']),
+        currency=transaction['transactionAmount']['currency'],
+        reference=transaction['remittanceInformationUnstructured'],
+    )
+
+    if 'transactionId' in transaction:
+        transaction_object.transaction_id = transaction['transactionId']
+
+    if 'creditorName' in transaction:
+        transaction_object.creditorName = transaction['creditorName']
+    if 'creditorAccount' in transaction:
+        transaction_object.creditorAccount = transaction['creditorAccount']['bban']
+
+    if 'debtorName' in transaction:
+        transaction_object.debtorName = transaction['debtorName']
+    if 'debtorAccount' in transaction:
+        transaction_object.debtorAccount = transaction['debtorAccount']['bban']
+
+    if transaction_object.amount < 0 and 'proprietaryBankTransactionCode' in transaction:
+        transaction_object.transactions_code = transaction['proprietaryBankTransactionCode']
+
+    check_lengths(transaction_object)
+
+    return transaction_object
+
+
+def check_lengths(transaction_object):
+    # Postgres fails the whole insert statement on an over-long value, so
+    # those rows are rejected here rather than taking their batch down.
+    for model_field in Transaction._meta.concrete_fields:
+        value = getattr(transaction_object, model_field.attname)
+        if model_field.max_length is not None and value is not None and len(str(value)) > model_field.max_length:
+            raise ValueError(f"{model_field.name} is longer than {model_field.max_length} characters")
+
+
+def rejection(index, internal_transaction_id, error):
+    return {
+        "index": index,
+        "internalTransactionId": internal_transaction_id,
+        "error": f"{type(error).__name__}: {error}",
+    }
+
+
+def map_transactions(account, booked_transactions):
+    result = IngestionResult()
+    transaction_objects = {}
+
+    for index, transaction in enumerate(booked_transactions):
+        try:
+            transaction_object = map_transaction(account, transaction)
+        except (KeyError, TypeError, ValueError) as error:
+            result.rejected += 1
+            result.errors.append(rejection(
+                index, transaction.get('internalTransactionId') if isinstance(transaction, dict) else None, error))
+            continue
+
+        if transaction_object.internal_transaction_id in transaction_objects:
+            result.duplicates += 1
+        else:
+            transaction_objects[transaction_object.internal_transaction_id] = transaction_object
+
+    return list(transaction_objects.values()), result
+
+
+def ingest_transactions(account, booked_transactions, batch_size=INGEST_BATCH_SIZE):
+    transaction_objects, result = map_transactions(account, booked_transactions)
+
+    for start in range(0, len(transaction_objects), batch_size):
+        result.merge(insert_batch(account, transaction_objects[start:start + batch_size]))
+
+    if result.transaction_ids:
+        new_transactions = Transaction.objects.filter(id__in=result.transaction_ids)
+        matched = tagging.apply_rules(account.user, new_transactions)
+        result.tagged = sum(len(transaction_ids) for transaction_ids in matched.values())
+        reports.refresh_transactions(account.user_id, new_transactions)
+        changes.record(account.user_id, ChangeEvent.TRANSACTION, result.transaction_ids)
+
+    return result
+
+
+def existing_internal_ids(account, internal_ids):
+    return set(Transaction.objects
+               .filter(account=account, internal_transaction_id__in=internal_ids)
+               .values_list('internal_transaction_id', flat=True))
+
+
+def insert_batch(account, transaction_objects):
+    result = IngestionResult()
+
+    existing_ids = existing_internal_ids(account, [transaction.internal_transaction_id
+                                                   for transaction in transaction_objects])
+
+    new_transactions = [transaction for transaction in transaction_objects
+                        if transaction.internal_transaction_id not in existing_ids]
+    result.duplicates = len(transaction_objects) - len(new_transactions)
+
+    if not new_transactions:
+        return result
+
+    # A row inserted by a concurrent run between the lookup and the insert,
+    # or one the database refuses, fails the whole statement. The batch is
+    # then retried one row at a time so only the offending rows are lost.
+    try:
+        with atomic():
+            Transaction.objects.bulk_create(new_transactions)
+    except DatabaseError:
+        result.merge(insert_rows(account, new_transactions))
+        return result
+
+    result.transaction_ids = [transaction.id for transaction in new_transactions]
+    result.inserted = len(result.transaction_ids)
+
+    return result
+
+
+def insert_rows(account, transaction_objects):
+    result = IngestionResult()
+
+    for transaction in transaction_objects:
+        transaction.pk = None
+        try:
+            with atomic():
+                transaction.save(force_insert=True)
+        except DatabaseError as error:
+            if isinstance(error, IntegrityError) and Transaction.objects.filter(
+                    account=account, internal_transaction_id=transaction.internal_transaction_id).exists():
+                result.duplicates += 1
+            else:
+                result.rejected += 1
+                result.errors.append(rejection(None, transaction.internal_transaction_id, error))
+            continue
+
+        result.transaction_ids.append(transaction.id)
+        result.inserted += 1
+
+    return result
@@ -1,8 +1,63 @@
-from datetime import datetime, timedelta, timezone
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
 
 from django.core.management import BaseCommand
 
-from tx_app import models, nordigen, TransactionHelper
+from tx_app import models, nordigen, scheduler, TransactionHelper
+
+
+@dataclass
+class AccountFetch:
+    account: models.Account
+    date_from: date = None
+    transactions: dict = None
+    balance: str = None
+    error: Exception = None
+    result: object = None
+    fetch_seconds: float = 0
+    save_seconds: float = 0
+
+    @property
+    def status(self):
+        if isinstance(self.error, ValueError):
+            return "skipped"
+        elif self.error is not None:
+            return "failed"
+        else:
+            return "ok"
+
+
+def fetch_account(account_fetch, institution_limits):
+    # Runs on a worker thread, so only network calls happen here; the database
+    # writes for the account are applied by the caller once the fetch completes.
+    account = account_fetch.account
+    start = time.monotonic()
+    try:
+        with institution_limits[account.institution_id]:
+            account_fetch.transactions = nordigen.get_transactions(account.resource_id, date_from=account_fetch.date_from)
+            account_fetch.balance = nordigen.get_account_balance(account.resource_id)
+    except Exception as error:
+        account_fetch.error = error
+    account_fetch.fetch_seconds = time.monotonic() - start
+
+    return account_fetch
+
+
+def save_account(account_fetch):
+    # A malformed payload or a database error only fails this account, the
+    # same way a failed fetch does.
+    account = account_fetch.account
+    start = time.monotonic()
+    try:
+        account_fetch.result = account.save_transactions(account_fetch.transactions['transactions']['booked'])
+        account.update_balance(account_fetch.balance)
+    except Exception as error:
+        account_fetch.error = error
+    account_fetch.save_seconds = time.monotonic() - start
+
 
 class Command(BaseCommand):
     help = "Fetch transactions job"
@@ -13,35 +68,98 @@ class Command(BaseCommand):
             action="store_true",
             help="Force transactions to be collected even if they have been collected recently",
         )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Fetch the full transaction history instead of only the window since the last collection",
+        )
+        parser.add_argument(
+            "--overlap-days",
+            type=int,
+            default=models.WATERMARK_OVERLAP_DAYS,
+            help="Number of days before the last collected booking date to fetch again",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of accounts fetched from Nordigen concurrently",
+        )
+        parser.add_argument(
+            "--per-institution",
+            type=int,
+            default=2,
+            help="Maximum number of concurrent fetches against a single institution",
+        )
+        parser.add_argument(
+            "--shard",
+            type=scheduler.parse_shard,
+            help="Only collect the i-th of N shards of users, given as i/N",
+        )
+        parser.add_argument(
+            "--user",
+            help="Only collect accounts belonging to this username",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            help="Maximum number of accounts claimed by this run",
+        )
 
 
     def handle(self, *args, **options):
-        skipped = 0
+        accounts = scheduler.claim_accounts(datetime.now(tz=timezone.utc), limit=options['limit'], force=options['force'],
+                                            shard=options['shard'], username=options['user'])
+
+        try:
+            account_fetches = [AccountFetch(account, None if options['full'] else account.transactions_watermark(options['overlap_days']))
+                               for account in accounts]
+            self.collect(account_fetches, options)
+        finally:
+            scheduler.release_accounts(accounts)
 
-        username = 'hardings'
-        user = models.User.objects.get(username=username)
+        skipped = len([account_fetch for account_fetch in account_fetches if account_fetch.status == "skipped"])
+        print(f"Transactions imported at {datetime.now()}, skipped: {skipped}")
+        self.print_summary(account_fetches)
 
-        accounts = models.Account.objects.filter(user=user)
+        users = {account.user_id: account.user for account in accounts}
+        for user_id, user in users.items():
+            transaction_ids = [transaction_id for account_fetch in account_fetches
+                               if account_fetch.account.user_id == user_id and account_fetch.result is not None
+                               for transaction_id in account_fetch.result.transaction_ids]
+            print(f"Finding Links for {user.username} across {len(transaction_ids)} new transactions")
+            TransactionHelper.find_links_for(user, transaction_ids)
 
-        transactions_collected = False
+    @staticmethod
+    def collect(account_fetches, options):
+        institution_limits = {account_fetch.account.institution_id: threading.BoundedSemaphore(max(options['per_institution'], 1))
+                              for account_fetch in account_fetches}
 
-        for account in accounts:
-            should_collect_transactions = (options['force'] or
-               (account.last_collected_transactions is None or account.last_collected_transactions < datetime.now(tz=timezone.utc) - timedelta(hours=6)))
+        with ThreadPoolExecutor(max_workers=max(options['workers'], 1)) as executor:
+            futures = [executor.submit(fetch_account, account_fetch, institution_limits)
+                       for account_fetch in account_fetches]
 
-            if should_collect_transactions:
-                print(f"importing transactions from {account.name} : {account.institution.name}")
-                transactions_collected = True
-                try:
-                    transactions = nordigen.get_transactions(account.resource_id)
-                    account.save_transactions(transactions['transactions']['booked'])
-                    account.update_balance(nordigen.get_account_balance(account.resource_id))
-                except ValueError as e:
-                    skipped += 1
+            for future in as_completed(futures):
+                account_fetch = future.result()
+                account = account_fetch.account
+                print(f"importing transactions from {account.name} : {account.institution.name} "
+                      f"from {account_fetch.date_from or 'the start of the history'}")
+                if account_fetch.error is None:
+                    save_account(account_fetch)
 
-                print(f"Transactions imported at {datetime.now()}, skipped: {skipped}")
+                if account_fetch.error is None:
+                    print(f"{account.name} : {account_fetch.result}")
+                else:
+                    print(f"{account.name} : {account_fetch.status}: {account_fetch.error}")
 
+    @staticmethod
+    def print_summary(account_fetches):
+        print(f"{'account':<30} {'institution':<30} {'status':<8} {'fetch s':>8} {'save s':>8} {'inserted':>9}")
+        for account_fetch in account_fetches:
+            account = account_fetch.account
+            inserted = account_fetch.result.inserted if account_fetch.result is not None else '-'
+            print(f"{str(account.name)[:30]:<30} {account.institution.name[:30]:<30} {account_fetch.status:<8} "
+                  f"{account_fetch.fetch_seconds:>8.2f} {account_fetch.save_seconds:>8.2f} {inserted:>9}")
 
-        if transactions_collected:
-            print("Finding Links")
-            TransactionHelper.find_links(user)
+        for endpoint, stats in nordigen.client.stats().items():
+            print(f"{endpoint}: {stats}")
@@ -0,0 +1,22 @@
+from django.core.management import BaseCommand
+
+from tx_app import models, reports
+
+
+class Command(BaseCommand):
+    help = "Rebuild the monthly spend rollups used by the reports endpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user",
+            help="Only rebuild the rollups of this username",
+        )
+
+    def handle(self, *args, **options):
+        users = models.User.objects.all()
+        if options['user'] is not None:
+            users = users.filter(username=options['user'])
+
+        for user in users:
+            reports.rebuild(user.id)
+            print(f"Rebuilt rollups for {user.username}: {models.MonthlySpend.objects.filter(user=user).count()} rows")
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from tx_app import tagging
+
+
+class Command(BaseCommand):
+    help = "Run pending tag rule jobs, and jobs whose worker stopped before finishing"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit",
+            type=int,
+            help="Maximum number of jobs claimed at a time",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep polling for new jobs instead of exiting once none are left",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Seconds to wait between polls when looping",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            job_ids = tagging.claim_rule_jobs(timezone.now(), limit=options['limit'])
+
+            for job_id in job_ids:
+                job = tagging.run_rule_job(job_id)
+                print(f"Tag rule job {job.id} ({job.action} '{job.expression}'): {job.status}, processed: {job.processed}")
+
+            if not job_ids:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
@@ -1,8 +1,12 @@
 import datetime
 
 from django.db import models
-from django.contrib.auth.models import User
+from django.db.models import Subquery
+from django.db.models.functions import Coalesce
 from django.db.transaction import atomic
+from django.contrib.auth.models import User
+
+WATERMARK_OVERLAP_DAYS = 3
 
 
 
@@ -41,6 +45,7 @@ class Account(models.Model):
     balance = models.FloatField(null=True)
     account_name = models.CharField(max_length=200, null=True)
     last_collected_transactions = models.DateTimeField(null=True)
+    collection_claimed_until = models.DateTimeField(null=True)
     requisition = models.ForeignKey(Requisition, on_delete=models.SET_NULL, null=True)
     colour = models.CharField(max_length=50, null=True)
     type = models.ForeignKey(AccountType, on_delete=models.PROTECT)
@@ -72,47 +77,31 @@ class Account(models.Model):
     def update_balance(self, amount):
         self.balance = amount
         self.save()
+        UserDataVersion.bump(self.user_id)
 
-    def save_transactions(self, booked_transactions):
-        for transaction in booked_transactions:
-            keys = transaction.keys()
-            transactionObject = Transaction()
-            transactionObject.account = Account.objects.get(id__exact=self.id)
-            transactionObject.internal_transaction_id = transaction['internalTransactionId']
-            transactionObject.booking_date = transaction['bookingDate']
-            transactionObject.value_date = transaction['valueDate'] if 'valueDate' in keys else None
-            transactionObject.booking_date_time = transaction['bookingDateTime']
-            transactionObject.value_date_time = transaction['valueDateTime'] if 'valueDateTime' in keys else None
-
-            transactionObject.amount = transaction['transactionAmount']['amount']
-            transactionObject.currency = transaction['transactionAmount']['currency']
-            transactionObject.reference = transaction['remittanceInformationUnstructured']
-
-            if "transactionId" in transaction.keys():
-                transactionObject.transaction_id = transaction['transactionId']
-
-            if "creditorName" in transaction.keys():
-                transactionObject.creditorName = transaction["creditorName"]
-            if "creditorAccount" in transaction.keys():
-                transactionObject.creditorAccount = transaction["creditorAccount"]["bban"]
-
-            if "debtorName" in transaction.keys():
-                transactionObject.debtorName = transaction["debtorName"]
-            if "debtorAccount" in transaction.keys():
-                transactionObject.debtorAccount = transaction["debtorAccount"]["bban"]
-
-            if float(transactionObject.amount) < 0 and 'proprietaryBankTransactionCode' in transaction.keys():
-                transactionObject.transactions_code = transaction['proprietaryBankTransactionCode']
-
-            try:
-                with atomic():
-                    transactionObject.save()
-            except Exception as exception:
-                print("Transaction skipped: " + str(exception))
+    def save_transactions(self, booked_transactions, batch_size=None):
+        from tx_app.ingestion import ingest_transactions, INGEST_BATCH_SIZE
+
+        result = ingest_transactions(self, booked_transactions, batch_size or INGEST_BATCH_SIZE)
 
         self.last_collected_transactions = datetime.datetime.now()
         self.save()
 
+        return result
+
+    def transactions_watermark(self, overlap_days=WATERMARK_OVERLAP_DAYS):
+        latest_booking_date = (Transaction.objects.filter(account=self)
+                               .aggregate(latest=models.Max('booking_date'))['latest'])
+
+        if latest_booking_date is not None:
+            watermark = latest_booking_date
+        elif self.last_collected_transactions is not None:
+            watermark = self.last_collected_transactions.date()
+        else:
+            return None
+
+        return watermark - datetime.timedelta(days=overlap_days)
+
     def has_requisition_expired(self):
         today = datetime.date.today()
         return self.requisition.expires <= today
@@ -165,13 +154,14 @@ class Holiday(models.Model):
             "img": self.img_url
         }
 
-    def serialize_with_financial_summary(self):
+    def serialize_with_financial_summary(self, summary=None):
+        from tx_app.holiday_summary import summarise
+
+        if summary is None:
+            summary = summarise(self.user_id, [self])[self.id]
+
         holiday_data = self.serialize()
-        holiday_transactions = Transaction.objects.filter(account__user=self.user, holiday=self)
-        holiday_data['total'] = round(sum([t.amount for t in holiday_transactions]), 2)
-        holiday_data['travel'] = round(sum([t.amount for t in holiday_transactions if t.tag is not None and t.tag.parent is not None and t.tag.parent.name == 'Travel' and t.tag.name != 'Hotels']), 2)
-        holiday_data['hotels'] = round(sum([t.amount for t in holiday_transactions if t.tag is not None and t.tag.name == 'Hotels']), 2)
-        holiday_data['food'] = round(sum([t.amount for t in holiday_transactions if t.tag is not None and t.tag.name == 'Eating Out']), 2)
+        holiday_data.update(summary)
 
         return holiday_data
 
@@ -197,8 +187,14 @@ class Transaction(models.Model):
     debtorAccount = models.CharField(max_length=200, null=True)
     
     account = models.ForeignKey(Account, models.CASCADE)
+    # Copied from the account, which never changes hands, so a user's pages
+    # are read from one index without joining accounts.
+    user = models.ForeignKey(User, models.CASCADE)
 
     tag = models.ForeignKey(Tag, models.SET_NULL, null=True)
+    # Set when a tag rule assigned the tag, so deleting a rule never clears
+    # a tag the user chose by hand.
+    tagged_by_rule = models.BooleanField(default=False)
 
     holiday = models.ForeignKey(Holiday, models.SET_NULL, null=True)
 
@@ -206,6 +202,10 @@ class Transaction(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['account', 'internal_transaction_id'], name='unique_transaction')
         ]
+        indexes = [
+            models.Index(fields=['account', '-booking_date_time', '-id'], name='transaction_account_time'),
+            models.Index(fields=['user', '-booking_date_time', '-id'], name='transaction_user_time'),
+        ]
 
     def serialize(self):
         return {
@@ -240,6 +240,7 @@ class Transaction(models.Model):
 class TransactionLink(models.Model):
     from_transaction = models.OneToOneField(Transaction, related_name="from_transaction", on_delete=models.CASCADE)
     to_transaction = models.OneToOneField(Transaction, related_name="to_transaction", on_delete=models.CASCADE)
+    confidence = models.FloatField(default=1.0)
 
     def serialize(self):
         from_transaction = self.from_transaction
@@ -255,6 +256,7 @@ class TransactionLink(models.Model):
             "bookingDate": to_transaction.booking_date,
             "bookingDateTime": to_transaction.booking_date_time,
             "reference": to_transaction.reference,
+            "confidence": self.confidence,
         }
 
 
@@ -268,3 +270,153 @@ class TagRule(models.Model):
             "id": self.id,
             "expression": self.expression
         }
+
+
+class MonthlySpend(models.Model):
+    user = models.ForeignKey(User, models.CASCADE)
+    year = models.IntegerField()
+    month = models.IntegerField()
+    tag = models.ForeignKey(Tag, models.CASCADE, null=True)
+    category = models.ForeignKey(Category, models.SET_NULL, null=True)
+    is_savings = models.BooleanField(default=False)
+    on_holiday = models.BooleanField(default=False)
+    total = models.FloatField(default=0)
+    count = models.IntegerField(default=0)
+    unlinked_count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'year', 'month'], name='monthly_spend_user_month')
+        ]
+
+
+class TagRuleJob(models.Model):
+    APPLY, REMOVE = 'APPLY', 'REMOVE'
+    PENDING, RUNNING, DONE, FAILED = 'PENDING', 'RUNNING', 'DONE', 'FAILED'
+
+    user = models.ForeignKey(User, models.CASCADE)
+    tag = models.ForeignKey(Tag, models.CASCADE)
+    expression = models.CharField(max_length=200)
+    action = models.CharField(max_length=20)
+    status = models.CharField(max_length=20, default=PENDING)
+    matched = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    error = models.TextField(null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    claimed_until = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    def serialize(self):
+        return {
+            "jobId": self.id,
+            "action": self.action,
+            "status": self.status,
+            "matched": self.matched,
+            "processed": self.processed,
+            "error": self.error,
+        }
+
+
+class ProviderToken(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    access_token = models.TextField(null=True)
+    access_expires = models.DateTimeField(null=True)
+    refresh_token = models.TextField(null=True)
+    refresh_expires = models.DateTimeField(null=True)
+    lock_owner = models.CharField(max_length=32, null=True)
+    lock_expires = models.DateTimeField(null=True)
+
+
+class UserDataVersion(models.Model):
+    # Bumped on every write that changes what a user's endpoints return, so
+    # cached responses keyed on the version go stale without being deleted.
+    user = models.OneToOneField(User, models.CASCADE, primary_key=True)
+    version = models.BigIntegerField(default=0)
+
+    @staticmethod
+    def current(user_id):
+        data_version, created = UserDataVersion.objects.get_or_create(user_id=user_id)
+        return data_version.version
+
+    @staticmethod
+    def bump(user_id):
+        # The row stays locked by the update until the surrounding transaction
+        # commits, so versions become visible in the order they were handed out.
+        with atomic(savepoint=False):
+            if not UserDataVersion.objects.filter(user_id=user_id).update(version=models.F('version') + 1):
+                data_version, created = UserDataVersion.objects.get_or_create(user_id=user_id, defaults={'version': 1})
+                if not created:
+                    UserDataVersion.objects.filter(user_id=user_id).update(version=models.F('version') + 1)
+
+            return UserDataVersion.objects.values_list('version', flat=True).get(user_id=user_id)
+
+    @staticmethod
+    def current_with_global(user_id):
+        # The user's version and the global one, read together in one query.
+        global_version = GlobalDataVersion.objects.filter(id=GlobalDataVersion.ID).values('version')
+        versions = (UserDataVersion.objects
+                    .filter(user_id=user_id)
+                    .annotate(global_version=Coalesce(Subquery(global_version), 0))
+                    .values_list('version', 'global_version')
+                    .first())
+
+        if versions is None:
+            UserDataVersion.objects.get_or_create(user_id=user_id)
+            return UserDataVersion.current_with_global(user_id)
+
+        return versions
+
+
+class GlobalDataVersion(models.Model):
+    # One row bumped on writes that change every user's data, global tags, so
+    # every cached response goes stale with a single write rather than one per user.
+    ID = 1
+
+    version = models.BigIntegerField(default=0)
+
+    @staticmethod
+    def bump():
+        with atomic(savepoint=False):
+            if not GlobalDataVersion.objects.filter(id=GlobalDataVersion.ID).update(version=models.F('version') + 1):
+                data_version, created = GlobalDataVersion.objects.get_or_create(id=GlobalDataVersion.ID, defaults={'version': 1})
+                if not created:
+                    GlobalDataVersion.objects.filter(id=GlobalDataVersion.ID).update(version=models.F('version') + 1)
+
+            return GlobalDataVersion.objects.values_list('version', flat=True).get(id=GlobalDataVersion.ID)
+
+
+class ChangeEvent(models.Model):
+    TRANSACTION, LINK, TAG, RULE = 'transaction', 'link', 'tag', 'rule'
+
+    # One row per changed object holding its latest sequence, so the feed
+    # stays as small as the data itself no matter how often rows change.
+    user = models.ForeignKey(User, models.CASCADE)
+    kind = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    sequence = models.BigIntegerField()
+    deleted = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'kind', 'object_id'], name='unique_change_event')
+        ]
+        indexes = [
+            models.Index(fields=['user', 'sequence'], name='change_event_user_sequence')
+        ]
+
+
+class GlobalChangeEvent(models.Model):
+    # Changes to objects every user sees, recorded once and sequenced by the
+    # global version instead of being copied into each user's feed.
+    kind = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    sequence = models.BigIntegerField()
+    deleted = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='unique_global_change_event')
+        ]
+        indexes = [
+            models.Index(fields=['sequence'], name='global_change_event_sequence')
+        ]
@@ -1,30 +1,24 @@
 import datetime
 import logging
-
-from requests import get, post, delete
+import random
+import threading
+import time
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError, ConnectTimeout, Timeout
+from urllib3.exceptions import NewConnectionError
 from dotenv import dotenv_values, find_dotenv
 import json
 from dataclasses import dataclass
 
-secrets = dotenv_values(find_dotenv())
-
-
-class Token:
-    def __init__(self, token: str, expires_in_seconds: int):
-        self.token = token
-        self.expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in_seconds)
-
-    def is_valid(self):
-        if datetime.datetime.now() > self.expires:
-            return False
-        else:
-            return True
+from tx_app.token_store import Token, create_token_store
 
-    def __repr__(self):
-        return self.token
+secrets = dotenv_values(find_dotenv())
 
-    def __str__(self):
-        return self.token
+TOKEN_REFRESH_MARGIN_SECONDS = 300
 
 
 class Endpoint:
@@ -115,32 +109,63 @@ class InstitutionList(list):
 
 
 class Auth:
-    _access_token: Token = None
-    _refresh_token: Token = None
+    store = create_token_store(secrets.get("NORDIGEN_TOKEN_STORE") or "database")
+    _background_refresh = threading.Lock()
 
     @classmethod
     def get_access_token(cls):
-        if cls._access_token is None:
-            cls._access_token, cls._refresh_token = cls.request_tokens()
-        elif not cls._access_token.is_valid():
-            if cls._refresh_token.is_valid():
-                cls._access_token = cls.refresh_access_token()
-            else:
-                cls._access_token, cls._refresh_token = cls.request_tokens()
+        access_token, refresh_token = cls.store.load()
+
+        if access_token is not None and access_token.is_valid():
+            if access_token.expires_within(TOKEN_REFRESH_MARGIN_SECONDS):
+                cls.refresh_in_background()
+            return access_token
+
+        return cls.renew_tokens()
+
+    @classmethod
+    def renew_tokens(cls, margin_seconds=0):
+        # Whoever holds the lock renews the tokens; everyone waiting on it
+        # picks up the renewed pair from the store instead of renewing again.
+        with cls.store.lock():
+            access_token, refresh_token = cls.store.load()
+
+            if access_token is None or access_token.expires_within(margin_seconds):
+                if refresh_token is not None and not refresh_token.expires_within(margin_seconds):
+                    access_token = cls.refresh_access_token(refresh_token)
+                else:
+                    access_token, refresh_token = cls.request_tokens()
+                cls.store.save(access_token, refresh_token)
+
+        return access_token
+
+    @classmethod
+    def refresh_in_background(cls):
+        if not cls._background_refresh.acquire(blocking=False):
+            return
+
+        def refresh():
+            try:
+                cls.renew_tokens(TOKEN_REFRESH_MARGIN_SECONDS)
+            except Exception as error:
+                logging.log(logging.ERROR, f"Background token refresh failed: {error}")
+            finally:
+                cls.store.close()
+                cls._background_refresh.release()
 
-        return cls._access_token
+        threading.Thread(target=refresh, daemon=True).start()
 
     @classmethod
-    def refresh_access_token(cls):
+    def refresh_access_token(cls, refresh_token: Token):
         headers = {
             "accept": "application/json",
             "Content-Type": "application/json",
         }
         data = {
-            "refresh": cls._refresh_token.token
+            "refresh": refresh_token.token
         }
 
-        response = post(Endpoint.REFRESH_TOKEN, json=data, headers=headers)
+        response = client.request("POST", "token/refresh", Endpoint.REFRESH_TOKEN, authenticated=False, json=data, headers=headers)
         response_data = json.loads(response.text)
 
         return Token(response_data['access'], response_data['access_expires'])
@@ -155,7 +180,7 @@ class Auth:
             "secret_id": secrets["NORDIGEN_ID"],
             "secret_key": secrets["NORDIGEN_KEY"]
         }
-        response = post(Endpoint.ACCESS_TOKEN, json=data, headers=headers)
+        response = client.request("POST", "token/new", Endpoint.ACCESS_TOKEN, authenticated=False, json=data, headers=headers)
 
         if response.status_code != 200:
             raise ConnectionError
@@ -176,36 +201,8 @@ class Auth:
         return headers
 
 
-def get_institutions(code: str):
-    headers = Auth.get_headers()
-    params = {
-        "country": code
-    }
-
-    response = get(Endpoint.INSTITUTIONS, params=params, headers=headers)
-
-    if response.status_code != 200:
-        raise ConnectionError
-
-    response_data = json.loads(response.text)
-
-    return InstitutionList(response_data)
-
-
-def get_end_user_agreement(institution: InstitutionData):
-    headers = Auth.get_headers()
-    data = {
-        "institution_id": institution.id
-    }
-
-    response = post(Endpoint.END_USER_AGREEMENT, data=data, headers=headers)
-
-    if response.status_code != 201:
-        raise ConnectionError
-
-    response_data = json.loads(response.text)
-
-    end_user_agreement = EndUserAgreement(
+def parse_end_user_agreement(response_data):
+    return EndUserAgreement(
         response_data["id"],
         response_data["created"],
         response_data["max_historical_days"],
@@ -215,51 +212,8 @@ def get_end_user_agreement(institution: InstitutionData):
         response_data["institution_id"]
     )
 
-    return end_user_agreement
-
-
-def create_requisition(reference: int, institution_id: str, redirect: str, agreement: EndUserAgreement = None):
-    headers = Auth.get_headers()
-    data = {
-        "redirect": redirect,
-        "institution_id": institution_id,
-        "reference": reference,
-    }
-
-    if agreement is not None:
-        data["agreement"] = agreement.id
-
-    response = post(Endpoint.REQUISITIONS, data=data, headers=headers)
-
-    if response.status_code != 201:
-        logging.log(logging.ERROR, response.text)
-        print(response.text)
-        raise ConnectionError
-
-    response_data = json.loads(response.text)
-
-    link = Requisition(
-        response_data["id"],
-        response_data["redirect"],
-        response_data["status"],
-        None,
-        response_data["accounts"],
-        response_data["reference"],
-        response_data["link"]
-    )
-
-    if 'agreements' in response_data:
-        link.agreements = response_data['agreements']
-
-    return link
-
-
-def get_requisition(id: str):
-    headers = Auth.get_headers()
-
-    response = get(Endpoint.REQUISITIONS + id, headers=headers)
-    response_data = json.loads(response.text)
 
+def parse_requisition(response_data):
     requisition = Requisition(
         response_data["id"],
         response_data["redirect"],
@@ -276,11 +230,7 @@ def get_requisition(id: str):
     return requisition
 
 
-def get_account(account_id: str):
-    headers = Auth.get_headers()
-
-    response = get(Endpoint.ACCOUNT_DETAILS(account_id), headers=headers)
-    response_data = json.loads(response.text)
+def parse_account(response_data):
     response_data = response_data['account']
 
     account = Account(
@@ -309,38 +259,287 @@ def get_account(account_id: str):
     return account
 
 
-def get_account_balance(account_id):
-    headers = Auth.get_headers()
-
-    response = get(Endpoint.ACCOUNT_BALANCE(account_id), headers=headers)
-    response_data = json.loads(response.text)
+def parse_account_balance(response_data):
     balances = response_data['balances']
     balance_amount = balances[0]['balanceAmount']
-    amount = balance_amount['amount']
 
-    return amount
+    return balance_amount['amount']
 
 
-def get_transactions(account_id: str):
-    headers = Auth.get_headers()
+def transactions_params(date_from: datetime.date = None, date_to: datetime.date = None):
+    params = {}
 
-    response = get(Endpoint.TRANSACTIONS(account_id), headers=headers)
+    if date_from is not None:
+        params["date_from"] = date_from.isoformat()
+    if date_to is not None:
+        params["date_to"] = date_to.isoformat()
 
-    response_data = json.loads(response.text)
+    return params
 
-    if response.status_code == 400 and 'expired' in response_data['summary']:
+
+def check_transactions_response(account_id, status_code, response_data):
+    if status_code == 400 and 'expired' in response_data['summary']:
         raise ValueError(f"EUA has expired for account with id: {account_id}")
 
-    return response_data
 
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
-def delete_requisition(requisition_id):
-    headers = Auth.get_headers()
+# A POST that reached the server may have created its agreement, requisition
+# or token even when the response was an error or never arrived, so only
+# these methods are retried after that point. Other methods are retried on
+# a 429, which is returned before the request is processed, or when the
+# connection was never established.
+IDEMPOTENT_METHODS = {"GET", "HEAD", "DELETE"}
+UNPROCESSED_STATUS_CODES = {429}
 
-    response = delete(Endpoint.REQUISITIONS + requisition_id, headers=headers)
 
-    if str(response.status_code)[0] != '2':
-        logging.log(logging.ERROR, response.text)
-        return False
-    else:
+def retry_status_codes(method):
+    return RETRY_STATUS_CODES if method in IDEMPOTENT_METHODS else UNPROCESSED_STATUS_CODES
+
+
+def never_sent(error):
+    # requests raises ConnectionError both for refused connections and for
+    # ones dropped mid-response; only the former wraps a NewConnectionError.
+    if isinstance(error, ConnectTimeout):
         return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def retry_after_seconds(retry_after):
+    if retry_after is None:
+        return None
+
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+    return max((retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+
+
+def backoff_seconds(attempt, backoff_factor, max_backoff):
+    delay = min(backoff_factor * (2 ** attempt), max_backoff)
+    return delay + random.uniform(0, delay)
+
+
+@dataclass
+class EndpointStats:
+    calls: int = 0
+    retries: int = 0
+    failures: int = 0
+    total_seconds: float = 0
+    max_seconds: float = 0
+
+    def record(self, seconds):
+        self.calls += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def serialize(self):
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "averageSeconds": round(self.total_seconds / self.calls, 4) if self.calls else 0,
+            "maxSeconds": round(self.max_seconds, 4),
+        }
+
+
+class BaseNordigenClient:
+    def __init__(self, connect_timeout=5, read_timeout=60, max_retries=4, backoff_factor=0.5, max_backoff=30):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+        self._stats = defaultdict(EndpointStats)
+        self._stats_lock = threading.Lock()
+
+    def _should_retry(self, attempt, method, response):
+        return response.status_code in retry_status_codes(method) and attempt < self.max_retries
+
+    def _should_retry_error(self, attempt, method, error):
+        return attempt < self.max_retries and (method in IDEMPOTENT_METHODS or self._never_sent(error))
+
+    @staticmethod
+    def _never_sent(error):
+        return never_sent(error)
+
+    def _retry_delay(self, attempt, response=None):
+        delay = retry_after_seconds(response.headers.get("Retry-After")) if response is not None else None
+        if delay is None:
+            delay = backoff_seconds(attempt, self.backoff_factor, self.max_backoff)
+
+        return min(delay, self.max_backoff)
+
+    def _record(self, endpoint, seconds, failed=False):
+        with self._stats_lock:
+            stats = self._stats[endpoint]
+            stats.record(seconds)
+            if failed:
+                stats.failures += 1
+
+    def _record_retry(self, endpoint):
+        with self._stats_lock:
+            self._stats[endpoint].retries += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return {endpoint: stats.serialize() for endpoint, stats in self._stats.items()}
+
+
+class NordigenClient(BaseNordigenClient):
+    def __init__(self, pool_size=10, **kwargs):
+        super().__init__(**kwargs)
+
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, endpoint, url, authenticated=True, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            if authenticated:
+                kwargs["headers"] = Auth.get_headers()
+
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=(self.connect_timeout, self.read_timeout), **kwargs)
+            except (RequestsConnectionError, Timeout) as error:
+                retry = self._should_retry_error(attempt, method, error)
+                self._record(endpoint, time.monotonic() - start, failed=not retry)
+                if not retry:
+                    raise
+                delay = self._retry_delay(attempt)
+                logging.log(logging.WARNING, f"{method} {endpoint} failed ({error}), retrying in {delay:.1f}s")
+            else:
+                retry = self._should_retry(attempt, method, response)
+                self._record(endpoint, time.monotonic() - start, failed=response.status_code in RETRY_STATUS_CODES and not retry)
+                if not retry:
+                    return response
+                delay = self._retry_delay(attempt, response)
+                logging.log(logging.WARNING, f"{method} {endpoint} returned {response.status_code}, retrying in {delay:.1f}s")
+
+            self._record_retry(endpoint)
+            time.sleep(delay)
+
+    def get_institutions(self, code: str):
+        params = {
+            "country": code
+        }
+
+        response = self.request("GET", "institutions", Endpoint.INSTITUTIONS, params=params)
+
+        if response.status_code != 200:
+            raise ConnectionError
+
+        response_data = json.loads(response.text)
+
+        return InstitutionList(response_data)
+
+    def get_end_user_agreement(self, institution: InstitutionData):
+        data = {
+            "institution_id": institution.id
+        }
+
+        response = self.request("POST", "agreements", Endpoint.END_USER_AGREEMENT, data=data)
+
+        if response.status_code != 201:
+            raise ConnectionError
+
+        return parse_end_user_agreement(json.loads(response.text))
+
+    def create_requisition(self, reference: int, institution_id: str, redirect: str, agreement: EndUserAgreement = None):
+        data = {
+            "redirect": redirect,
+            "institution_id": institution_id,
+            "reference": reference,
+        }
+
+        if agreement is not None:
+            data["agreement"] = agreement.id
+
+        response = self.request("POST", "requisitions", Endpoint.REQUISITIONS, data=data)
+
+        if response.status_code != 201:
+            logging.log(logging.ERROR, response.text)
+            print(response.text)
+            raise ConnectionError
+
+        return parse_requisition(json.loads(response.text))
+
+    def get_requisition(self, id: str):
+        response = self.request("GET", "requisition", Endpoint.REQUISITIONS + id)
+
+        return parse_requisition(json.loads(response.text))
+
+    def get_account(self, account_id: str):
+        response = self.request("GET", "account/details", Endpoint.ACCOUNT_DETAILS(account_id))
+
+        return parse_account(json.loads(response.text))
+
+    def get_account_balance(self, account_id):
+        response = self.request("GET", "account/balances", Endpoint.ACCOUNT_BALANCE(account_id))
+
+        return parse_account_balance(json.loads(response.text))
+
+    def get_transactions(self, account_id: str, date_from: datetime.date = None, date_to: datetime.date = None):
+        params = transactions_params(date_from, date_to)
+
+        response = self.request("GET", "account/transactions", Endpoint.TRANSACTIONS(account_id), params=params)
+
+        response_data = json.loads(response.text)
+        check_transactions_response(account_id, response.status_code, response_data)
+
+        return response_data
+
+    def delete_requisition(self, requisition_id):
+        response = self.request("DELETE", "requisition", Endpoint.REQUISITIONS + requisition_id)
+
+        if str(response.status_code)[0] != '2':
+            logging.log(logging.ERROR, response.text)
+            return False
+        else:
+            return True
+
+
+client = NordigenClient()
+
+
+def get_institutions(code: str):
+    return client.get_institutions(code)
+
+
+def get_end_user_agreement(institution: InstitutionData):
+    return client.get_end_user_agreement(institution)
+
+
+def create_requisition(reference: int, institution_id: str, redirect: str, agreement: EndUserAgreement = None):
+    return client.create_requisition(reference, institution_id, redirect, agreement)
+
+
+def get_requisition(id: str):
+    return client.get_requisition(id)
+
+
+def get_account(account_id: str):
+    return client.get_account(account_id)
+
+
+def get_account_balance(account_id):
+    return client.get_account_balance(account_id)
+
+
+def get_transactions(account_id: str, date_from: datetime.date = None, date_to: datetime.date = None):
+    return client.get_transactions(account_id, date_from, date_to)
+
+
+def delete_requisition(requisition_id):
+    return client.delete_requisition(requisition_id)
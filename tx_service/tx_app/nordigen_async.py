@@ -0,0 +1,162 @@
+import asyncio
+import json
+import logging
+import time
+
+import httpx
+from asgiref.sync import sync_to_async
+
+from tx_app.nordigen import (Auth, BaseNordigenClient, EndUserAgreement, Endpoint, InstitutionData, InstitutionList,
+                             RETRY_STATUS_CODES, check_transactions_response, parse_account, parse_account_balance,
+                             parse_end_user_agreement, parse_requisition, transactions_params)
+
+
+class AsyncNordigenClient(BaseNordigenClient):
+    def __init__(self, pool_size=10, transport=None, **kwargs):
+        super().__init__(**kwargs)
+        self.transport = transport
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.timeout = httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+        self.session = None
+
+    @staticmethod
+    def _never_sent(error):
+        return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+    async def __aenter__(self):
+        self.session = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, transport=self.transport)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.aclose()
+        self.session = None
+
+    async def request(self, method, endpoint, url, authenticated=True, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            if authenticated:
+                kwargs["headers"] = await sync_to_async(Auth.get_headers)()
+
+            start = time.monotonic()
+            try:
+                response = await self.session.request(method, url, **kwargs)
+            except (httpx.ConnectError, httpx.TimeoutException) as error:
+                retry = self._should_retry_error(attempt, method, error)
+                self._record(endpoint, time.monotonic() - start, failed=not retry)
+                if not retry:
+                    raise
+                delay = self._retry_delay(attempt)
+                logging.log(logging.WARNING, f"{method} {endpoint} failed ({error}), retrying in {delay:.1f}s")
+            else:
+                retry = self._should_retry(attempt, method, response)
+                self._record(endpoint, time.monotonic() - start, failed=response.status_code in RETRY_STATUS_CODES and not retry)
+                if not retry:
+                    return response
+                delay = self._retry_delay(attempt, response)
+                logging.log(logging.WARNING, f"{method} {endpoint} returned {response.status_code}, retrying in {delay:.1f}s")
+
+            self._record_retry(endpoint)
+            await asyncio.sleep(delay)
+
+    async def get_institutions(self, code: str):
+        params = {
+            "country": code
+        }
+
+        response = await self.request("GET", "institutions", Endpoint.INSTITUTIONS, params=params)
+
+        if response.status_code != 200:
+            raise ConnectionError
+
+        return InstitutionList(json.loads(response.text))
+
+    async def get_end_user_agreement(self, institution: InstitutionData):
+        data = {
+            "institution_id": institution.id
+        }
+
+        response = await self.request("POST", "agreements", Endpoint.END_USER_AGREEMENT, data=data)
+
+        if response.status_code != 201:
+            raise ConnectionError
+
+        return parse_end_user_agreement(json.loads(response.text))
+
+    async def create_requisition(self, reference: int, institution_id: str, redirect: str, agreement: EndUserAgreement = None):
+        data = {
+            "redirect": redirect,
+            "institution_id": institution_id,
+            "reference": reference,
+        }
+
+        if agreement is not None:
+            data["agreement"] = agreement.id
+
+        response = await self.request("POST", "requisitions", Endpoint.REQUISITIONS, data=data)
+
+        if response.status_code != 201:
+            logging.log(logging.ERROR, response.text)
+            raise ConnectionError
+
+        return parse_requisition(json.loads(response.text))
+
+    async def get_requisition(self, id: str):
+        response = await self.request("GET", "requisition", Endpoint.REQUISITIONS + id)
+
+        return parse_requisition(json.loads(response.text))
+
+    async def get_account(self, account_id: str):
+        response = await self.request("GET", "account/details", Endpoint.ACCOUNT_DETAILS(account_id))
+
+        return parse_account(json.loads(response.text))
+
+    async def get_account_balance(self, account_id):
+        response = await self.request("GET", "account/balances", Endpoint.ACCOUNT_BALANCE(account_id))
+
+        return parse_account_balance(json.loads(response.text))
+
+    async def get_transactions(self, account_id: str, date_from=None, date_to=None):
+        params = transactions_params(date_from, date_to)
+
+        response = await self.request("GET", "account/transactions", Endpoint.TRANSACTIONS(account_id), params=params)
+
+        response_data = json.loads(response.text)
+        check_transactions_response(account_id, response.status_code, response_data)
+
+        return response_data
+
+    async def delete_requisition(self, requisition_id):
+        response = await self.request("DELETE", "requisition", Endpoint.REQUISITIONS + requisition_id)
+
+        if str(response.status_code)[0] != '2':
+            logging.log(logging.ERROR, response.text)
+            return False
+        else:
+            return True
+
+
+def failed(description, result):
+    if isinstance(result, BaseException):
+        logging.log(logging.ERROR, f"Fetching {description} failed: {result}")
+        return True
+    return False
+
+
+async def get_linked_accounts(requisition_ids, client=None):
+    # One client, and so one connection pool, serves every call for the
+    # request. A requisition or account that fails is logged and left out
+    # instead of failing the others.
+    async with client or AsyncNordigenClient() as client:
+        links = await asyncio.gather(*[client.get_requisition(requisition_id) for requisition_id in requisition_ids],
+                                     return_exceptions=True)
+        links = {requisition_id: link for requisition_id, link in zip(requisition_ids, links)
+                 if not failed(f"requisition {requisition_id}", link)}
+
+        account_ids = [account_id for link in links.values() for account_id in link.accounts]
+        accounts = await asyncio.gather(*[client.get_account(account_id) for account_id in account_ids],
+                                        return_exceptions=True)
+
+    accounts_by_id = {account_id: account for account_id, account in zip(account_ids, accounts)
+                      if not failed(f"account {account_id}", account)}
+    return {requisition_id: [(account_id, accounts_by_id[account_id]) for account_id in link.accounts
+                             if account_id in accounts_by_id]
+            for requisition_id, link in links.items()}
@@ -0,0 +1,89 @@
+import base64
+import datetime
+import json
+
+from django.db.models import Q
+
+import tx_app.Serialize as serialize
+from tx_app.models import Transaction
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+PAGE_PARAMS = ('from', 'to', 'account', 'cursor', 'limit')
+
+
+class PageError(ValueError):
+    pass
+
+
+def encode_cursor(transaction):
+    position = [transaction.booking_date_time.isoformat(), transaction.id]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        booking_date_time, transaction_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(booking_date_time), int(transaction_id)
+    except (ValueError, TypeError) as error:
+        raise PageError(f"Invalid cursor: {error}")
+
+
+def parse_date(value, name):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise PageError(f"Invalid {name} date: {value}")
+
+
+def parse_limit(value):
+    try:
+        limit = int(value)
+    except ValueError:
+        raise PageError(f"Invalid limit: {value}")
+
+    if limit < 1:
+        raise PageError(f"Invalid limit: {value}")
+
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def wants_page(query_params):
+    return any(param in query_params for param in PAGE_PARAMS)
+
+
+def transaction_page(user, query_params):
+    # Newest first, keyed on (booking_date_time, id) so each page is an index
+    # range scan starting where the previous one stopped, however deep it is.
+    # The user column drives the index scan. Rows are still checked against
+    # their account's owner until every existing row has had user backfilled.
+    transactions = Transaction.objects.filter(user=user, account__user=user)
+
+    if 'from' in query_params:
+        transactions = transactions.filter(booking_date__gte=parse_date(query_params['from'], 'from'))
+    if 'to' in query_params:
+        transactions = transactions.filter(booking_date__lte=parse_date(query_params['to'], 'to'))
+
+    account_ids = query_params.getlist('account')
+    if account_ids:
+        try:
+            transactions = transactions.filter(account_id__in=[int(account_id) for account_id in account_ids])
+        except ValueError:
+            raise PageError(f"Invalid account: {account_ids}")
+
+    if 'cursor' in query_params:
+        booking_date_time, transaction_id = decode_cursor(query_params['cursor'])
+        transactions = transactions.filter(Q(booking_date_time__lt=booking_date_time) |
+                                           Q(booking_date_time=booking_date_time, id__lt=transaction_id))
+
+    limit = parse_limit(query_params['limit']) if 'limit' in query_params else DEFAULT_PAGE_SIZE
+
+    page = list(transactions
+                .select_related('tag__category', 'holiday')
+                .order_by('-booking_date_time', '-id')[:limit + 1])
+
+    return {
+        'transactions': [serialize.transaction(transaction) for transaction in page[:limit]],
+        'nextCursor': encode_cursor(page[limit - 1]) if len(page) > limit else None,
+    }
@@ -1,3 +1,16 @@
+import calendar
+import copy
+import datetime
+from functools import reduce
+from operator import or_
+
+from django.db.models import BooleanField, Case, Count, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, ExtractMonth, ExtractYear
+from django.db.transaction import atomic
+
+from tx_app import tag_tree
+from tx_app.models import MonthlySpend, Tag, Transaction, UserDataVersion
+
 
 class Report:
     def __init__(self):
@@ -7,8 +20,161 @@ class Report:
 class MonthlyReport(Report):
     def __init__(self):
         super().__init__()
-        
+
 
 class YearlyReport(Report):
     def __init__(self):
-        super().__init__()
\ No newline at end of file
+        super().__init__()
+
+
+def construct_empty_report(categories, tags, sub_tags):
+    report = {
+        "untagged": 0
+    }
+
+    for category in categories:
+        report[category.code] = {}
+        report[category.code]["total"] = 0
+        report[category.code]["categories"] = {}
+
+    for tag in tags:
+        if tag.category is not None:
+            report[tag.category.code]["categories"][tag.name] = {"tag": tag.serialize(), "total": 0, "categories": {}}
+
+    for sub_tag in sub_tags:
+        parent = sub_tag.parent
+        if parent.category is not None:
+            report[parent.category.code]["categories"][parent.name]["categories"][sub_tag.name] = {"tag": sub_tag.serialize(), "total": 0}
+
+    return report
+
+
+def aggregate_months(transactions):
+    return (transactions
+            .annotate(year=ExtractYear('booking_date'),
+                      month=ExtractMonth('booking_date'),
+                      category_id=Coalesce('tag__category_id', 'tag__parent__category_id'),
+                      is_savings=Case(When(account__type__code='SAVINGS', then=Value(True)),
+                                      default=Value(False), output_field=BooleanField()),
+                      on_holiday=Case(When(holiday__isnull=False, then=Value(True)),
+                                      default=Value(False), output_field=BooleanField()))
+            .values('account__user_id', 'year', 'month', 'tag_id', 'category_id', 'is_savings', 'on_holiday')
+            .annotate(total=Sum('amount'),
+                      count=Count('id'),
+                      unlinked_count=Count('id', filter=Q(from_transaction__isnull=True, to_transaction__isnull=True)))
+            .order_by())
+
+
+def months_of(transactions):
+    return {(date.year, date.month) for date in transactions.dates('booking_date', 'month')}
+
+
+def lock_rollups(user_id):
+    # Rollup writes for a user queue on their data version row, so each one
+    # aggregates only after the previous one has committed and can never
+    # replace newer totals with ones read earlier.
+    UserDataVersion.objects.get_or_create(user_id=user_id)
+    UserDataVersion.objects.select_for_update().values_list('user_id', flat=True).get(user_id=user_id)
+
+
+def refresh_months(user_id, months):
+    if not months:
+        return
+
+    in_months = reduce(or_, [Q(booking_date__gte=datetime.date(year, month, 1),
+                               booking_date__lte=datetime.date(year, month, calendar.monthrange(year, month)[1]))
+                             for year, month in months])
+
+    with atomic():
+        lock_rollups(user_id)
+        rows = list(aggregate_months(Transaction.objects.filter(in_months, account__user_id=user_id)))
+        MonthlySpend.objects.filter(reduce(or_, [Q(year=year, month=month) for year, month in months]), user_id=user_id).delete()
+        MonthlySpend.objects.bulk_create([monthly_spend(row) for row in rows])
+
+
+def refresh_transactions(user_id, transactions):
+    refresh_months(user_id, months_of(transactions))
+
+
+def recategorise(tag_ids):
+    # Rollup rows carry their tag's category or else its parent's, the same
+    # as aggregate_months. Re-derive it for tags that were recategorised or
+    # moved to another parent, and for the sub-tags that inherit from them.
+    derived_category = (Tag.objects
+                        .filter(id=OuterRef('tag_id'))
+                        .annotate(derived_category_id=Coalesce('category_id', 'parent__category_id'))
+                        .values('derived_category_id')[:1])
+    MonthlySpend.objects.filter(Q(tag_id__in=tag_ids) | Q(tag__parent_id__in=tag_ids)).update(category_id=Subquery(derived_category))
+
+
+def rebuild(user_id):
+    with atomic():
+        lock_rollups(user_id)
+        rows = list(aggregate_months(Transaction.objects.filter(account__user_id=user_id)))
+        MonthlySpend.objects.filter(user_id=user_id).delete()
+        MonthlySpend.objects.bulk_create([monthly_spend(row) for row in rows])
+
+
+def monthly_spend(row):
+    return MonthlySpend(user_id=row['account__user_id'], year=row['year'], month=row['month'], tag_id=row['tag_id'],
+                        category_id=row['category_id'], is_savings=row['is_savings'], on_holiday=row['on_holiday'],
+                        total=row['total'], count=row['count'], unlinked_count=row['unlinked_count'])
+
+
+def build_report(rows, categories, tags, sub_tags):
+    # Rows are monthly (tag, category, savings, holiday) buckets, either
+    # MonthlySpend instances or the dicts produced by aggregate_months.
+    reports = {}
+
+    empty_report = construct_empty_report(categories, tags, sub_tags)
+    tags_by_id = {tag.id: tag for tag in list(tags) + list(sub_tags)}
+    category_codes = {category.id: category.code for category in categories}
+
+    def add_to_report(report, tag, category_code, total):
+        if tag.category_id is None and tag.parent_id is not None:
+            parent = tags_by_id[tag.parent_id]
+            report[category_code]["categories"][parent.name]["categories"][tag.name]["total"] += total
+            report[category_code]["categories"][parent.name]["total"] += total
+            report[category_code]["total"] += total
+        elif tag.category_id is not None:
+            report[category_code]["categories"][tag.name]["total"] += total
+            report[category_code]["total"] += total
+
+    for row in sorted(rows, key=lambda row: (row_value(row, 'year'), row_value(row, 'month'))):
+        year = row_value(row, 'year')
+        month = calendar.month_name[row_value(row, 'month')]
+        tag_id = row_value(row, 'tag_id')
+        total = row_value(row, 'total')
+
+        if year not in reports:
+            reports[year] = copy.deepcopy(empty_report)
+        if month not in reports[year]:
+            reports[year][month] = copy.deepcopy(empty_report)
+
+        if tag_id is None or row_value(row, 'on_holiday'):
+            if not row_value(row, 'on_holiday'):
+                reports[year][month]["untagged"] += row_value(row, 'unlinked_count')
+            if row_value(row, 'is_savings'):
+                reports[year][month]['SAVINGS']['total'] += total
+                reports[year]['SAVINGS']['total'] += total
+        elif tag_id in tags_by_id and row_value(row, 'category_id') in category_codes:
+            tag = tags_by_id[tag_id]
+            category_code = category_codes[row_value(row, 'category_id')]
+            add_to_report(reports[year][month], tag, category_code, total)
+            add_to_report(reports[year], tag, category_code, total)
+
+    return reports
+
+
+def row_value(row, name):
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+def rollup_report(user):
+    tree = tag_tree.get(user)
+    return build_report(MonthlySpend.objects.filter(user=user), tree.categories, tree.tags, tree.sub_tags)
+
+
+def live_report(user):
+    tree = tag_tree.get(user)
+    return build_report(aggregate_months(Transaction.objects.filter(account__user=user)), tree.categories, tree.tags, tree.sub_tags)
@@ -0,0 +1,107 @@
+import datetime
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+
+from tx_app.models import UserDataVersion
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ResponseCache:
+    # In-process LRU of encoded JSON bodies keyed on (user, endpoint, version),
+    # where the version pairs the user's own with the global one.
+    # Only the newest version of each (user, endpoint) is kept, older ones are
+    # dropped as soon as a fresh response replaces them.
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.latest = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            content = self.entries.get(key)
+            if content is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return content
+
+    def put(self, key, content):
+        if len(content) > self.max_bytes:
+            return
+
+        user_id, endpoint, version = key
+        with self.lock:
+            previous = self.latest.get((user_id, endpoint))
+            if previous is not None and previous[2] > version:
+                return
+            if previous is not None:
+                self._remove(previous)
+
+            self.entries[key] = content
+            self.latest[(user_id, endpoint)] = key
+            self.size += len(content)
+
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        content = self.entries.pop(key, None)
+        if content is not None:
+            self.size -= len(content)
+        if self.latest.get(key[:2]) == key:
+            del self.latest[key[:2]]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.latest.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRate": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+cache = ResponseCache(getattr(settings, 'RESPONSE_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+
+
+def cached_json(request, build, dated=False):
+    # The version is read before building, so a write landing mid-build only
+    # ever leaves a response filed under the version it already superseded.
+    # Dated responses hold flags computed from today's date, so the lookup is
+    # made for the day being served and yesterday's body is never returned.
+    user_id = request.user.id
+    version = UserDataVersion.current_with_global(user_id)
+    if dated:
+        version = (version, datetime.date.today().toordinal())
+    key = (user_id, request.get_full_path(), version)
+
+    content = cache.get(key)
+    if content is None:
+        content = JsonResponse(data=build()).content
+        cache.put(key, content)
+
+    return HttpResponse(content, content_type='application/json')
@@ -0,0 +1,58 @@
+from argparse import ArgumentTypeError
+from datetime import timedelta
+
+from django.db.models import F, Q
+from django.db.models.functions import Mod
+from django.db.transaction import atomic
+
+from tx_app.models import Account
+
+COLLECTION_INTERVAL = timedelta(hours=6)
+CLAIM_LEASE = timedelta(minutes=30)
+
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ArgumentTypeError(f"Shard must be given as i/N, got: {value}")
+
+    if count < 1 or not 0 <= index < count:
+        raise ArgumentTypeError(f"Shard index must be between 0 and {count - 1}, got: {value}")
+
+    return index, count
+
+
+def due_accounts(now, force=False, shard=None, username=None):
+    accounts = Account.objects.filter(Q(collection_claimed_until__isnull=True) | Q(collection_claimed_until__lt=now))
+
+    if not force:
+        accounts = accounts.filter(Q(last_collected_transactions__isnull=True) |
+                                   Q(last_collected_transactions__lt=now - COLLECTION_INTERVAL))
+
+    if username is not None:
+        accounts = accounts.filter(user__username=username)
+
+    # Shards split by user so that every account of a user is collected by the
+    # same worker, which can then find links across those accounts.
+    if shard is not None:
+        index, count = shard
+        accounts = accounts.annotate(shard=Mod('user_id', count)).filter(shard=index)
+
+    return accounts.order_by(F('last_collected_transactions').asc(nulls_first=True), 'id')
+
+
+def claim_accounts(now, limit=None, **filters):
+    with atomic():
+        account_ids = list(due_accounts(now, **filters)
+                           .select_for_update(skip_locked=True)
+                           .values_list('id', flat=True)[:limit])
+        Account.objects.filter(id__in=account_ids).update(collection_claimed_until=now + CLAIM_LEASE)
+
+    accounts = Account.objects.filter(id__in=account_ids).select_related('institution', 'user').in_bulk()
+
+    return [accounts[account_id] for account_id in account_ids]
+
+
+def release_accounts(accounts):
+    Account.objects.filter(id__in=[account.id for account in accounts]).update(collection_claimed_until=None)
@@ -0,0 +1,91 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from django.contrib.auth.models import User
+from django.db.models import F, Max, OuterRef, Q, Subquery
+
+from tx_app.models import Category, ChangeEvent, GlobalDataVersion, Tag, TagRule
+
+TREE_CACHE_SIZE = 256
+
+
+@dataclass
+class TagTree:
+    tags: list
+    sub_tags: list
+    children: dict
+    rules: dict
+    categories: list
+
+
+# Least recently used trees are evicted first, so a long-lived worker holds
+# at most TREE_CACHE_SIZE of them.
+_trees = OrderedDict()
+_trees_lock = threading.Lock()
+
+
+def tree_signature(user):
+    # The user's newest tag or rule event and the global version, which
+    # global tag edits bump, identify the tree. Read together in one query.
+    latest = (ChangeEvent.objects
+              .filter(user=OuterRef('id'), kind__in=[ChangeEvent.TAG, ChangeEvent.RULE])
+              .order_by()
+              .values('user')
+              .annotate(latest=Max('sequence'))
+              .values('latest'))
+    global_version = GlobalDataVersion.objects.filter(id=GlobalDataVersion.ID).values('version')
+
+    return (User.objects
+            .filter(id=user.id)
+            .annotate(latest=Subquery(latest), global_version=Subquery(global_version))
+            .values_list('latest', 'global_version')
+            .get())
+
+
+def load(user):
+    # Three queries: the visible tags with their categories, the user's
+    # rules and the categories.
+    visible_tags = list(Tag.objects
+                        .filter(Q(user=None) | Q(user=user))
+                        .select_related('category', 'parent__category')
+                        .order_by(F('user_id').asc(nulls_first=True), 'id'))
+
+    tags = [tag for tag in visible_tags if tag.parent_id is None]
+    children = {tag.id: [] for tag in tags}
+    sub_tags = []
+    for tag in visible_tags:
+        if tag.parent_id in children:
+            children[tag.parent_id].append(tag)
+            sub_tags.append(tag)
+
+    rules = {}
+    for rule in TagRule.objects.filter(user=user).order_by('id'):
+        rules.setdefault(rule.tag_id, []).append(rule)
+
+    return TagTree(tags=tags, sub_tags=sub_tags, children=children, rules=rules, categories=list(Category.objects.all()))
+
+
+def get(user):
+    signature = tree_signature(user)
+
+    with _trees_lock:
+        cached = _trees.get(user.id)
+        if cached is not None and cached[0] == signature:
+            _trees.move_to_end(user.id)
+            return cached[1]
+
+    tree = load(user)
+
+    with _trees_lock:
+        _trees[user.id] = (signature, tree)
+        _trees.move_to_end(user.id)
+        while len(_trees) > TREE_CACHE_SIZE:
+            _trees.popitem(last=False)
+
+    return tree
+
+
+def clear():
+    with _trees_lock:
+        _trees.clear()
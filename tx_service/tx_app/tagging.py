@@ -0,0 +1,228 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+from datetime import timedelta
+
+from django.db.models import Count, Max, Q
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from tx_app import changes, reports
+from tx_app.models import ChangeEvent, TagRule, TagRuleJob, Transaction
+
+RULE_JOB_CHUNK_SIZE = 1000
+RULE_JOB_LEASE = timedelta(minutes=10)
+MATCHER_CACHE_SIZE = 256
+
+
+class RuleMatcher:
+    # Aho-Corasick automaton over the lowercased rule expressions, so a
+    # reference is scanned once no matter how many rules the user has. When
+    # several rules match, the oldest rule wins, as it did when rules were
+    # applied one after another in id order.
+
+    def __init__(self, rules):
+        self.tag_ids = []
+        self.transitions = [{}]
+        self.fail = [0]
+        self.outputs = [None]
+
+        for rule_id, expression, tag_id in sorted(rules):
+            if expression:
+                self.tag_ids.append(tag_id)
+                self._add(expression.lower(), len(self.tag_ids) - 1)
+
+        self._build_failure_links()
+
+    def _add(self, expression, priority):
+        state = 0
+        for character in expression:
+            if character not in self.transitions[state]:
+                self.transitions.append({})
+                self.fail.append(0)
+                self.outputs.append(None)
+                self.transitions[state][character] = len(self.transitions) - 1
+            state = self.transitions[state][character]
+
+        if self.outputs[state] is None or priority < self.outputs[state]:
+            self.outputs[state] = priority
+
+    def _build_failure_links(self):
+        queue = deque(self.transitions[0].values())
+
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.transitions[state].items():
+                queue.append(next_state)
+
+                fallback = self.fail[state]
+                while fallback and character not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.transitions[fallback].get(character, 0)
+
+                # Fold the best output reachable through the failure link into
+                # this state so matching never has to walk the failure chain.
+                inherited = self.outputs[self.fail[next_state]]
+                if inherited is not None and (self.outputs[next_state] is None or inherited < self.outputs[next_state]):
+                    self.outputs[next_state] = inherited
+
+    def match(self, reference):
+        best = None
+        state = 0
+
+        for character in reference.lower():
+            while state and character not in self.transitions[state]:
+                state = self.fail[state]
+            state = self.transitions[state].get(character, 0)
+
+            output = self.outputs[state]
+            if output is not None and (best is None or output < best):
+                best = output
+                if best == 0:
+                    break
+
+        return self.tag_ids[best] if best is not None else None
+
+    def __len__(self):
+        return len(self.tag_ids)
+
+
+# Least recently used matchers are evicted first, so a long-lived worker
+# holds at most MATCHER_CACHE_SIZE of them.
+_matchers = OrderedDict()
+_matchers_lock = threading.Lock()
+
+
+def rules_signature(user):
+    summary = TagRule.objects.filter(user=user).aggregate(count=Count('id'), latest=Max('id'))
+    return summary['count'], summary['latest']
+
+
+def get_matcher(user):
+    signature = rules_signature(user)
+
+    with _matchers_lock:
+        cached = _matchers.get(user.id)
+        if cached is not None and cached[0] == signature:
+            _matchers.move_to_end(user.id)
+            return cached[1]
+
+    matcher = RuleMatcher(TagRule.objects.filter(user=user).values_list('id', 'expression', 'tag_id'))
+
+    with _matchers_lock:
+        _matchers[user.id] = (signature, matcher)
+        _matchers.move_to_end(user.id)
+        while len(_matchers) > MATCHER_CACHE_SIZE:
+            _matchers.popitem(last=False)
+
+    return matcher
+
+
+def apply_rules(user, transactions):
+    matcher = get_matcher(user)
+    if not len(matcher):
+        return {}
+
+    matched = {}
+    for transaction_id, reference in transactions.filter(tag__isnull=True).values_list('id', 'reference'):
+        tag_id = matcher.match(reference)
+        if tag_id is not None:
+            matched.setdefault(tag_id, []).append(transaction_id)
+
+    for tag_id, transaction_ids in matched.items():
+        Transaction.objects.filter(id__in=transaction_ids, tag__isnull=True).update(tag_id=tag_id, tagged_by_rule=True)
+
+    return matched
+
+
+def rule_job_transactions(job):
+    transactions = Transaction.objects.filter(account__user_id=job.user_id, reference__icontains=job.expression)
+
+    if job.action == TagRuleJob.APPLY:
+        return transactions.filter(tag__isnull=True)
+    else:
+        return transactions.filter(tag_id=job.tag_id, tagged_by_rule=True)
+
+
+def enqueue_rule_job(user, tag, expression, action):
+    # Jobs are picked up by the run_rule_jobs command rather than a thread in
+    # the web process, so they survive a worker restart.
+    job = TagRuleJob(user=user, tag=tag, expression=expression, action=action)
+    job.matched = rule_job_transactions(job).count()
+    job.save()
+
+    return job
+
+
+def claim_rule_jobs(now, limit=None):
+    # Pending jobs, and running jobs whose worker stopped renewing the lease,
+    # are claimed under row locks so concurrent workers never share a job.
+    with atomic():
+        job_ids = list(TagRuleJob.objects
+                       .filter(Q(status=TagRuleJob.PENDING) |
+                               Q(status=TagRuleJob.RUNNING, claimed_until__lt=now))
+                       .select_for_update(skip_locked=True)
+                       .order_by('id')
+                       .values_list('id', flat=True)[:limit])
+        TagRuleJob.objects.filter(id__in=job_ids).update(status=TagRuleJob.RUNNING,
+                                                          claimed_until=now + RULE_JOB_LEASE)
+
+    return job_ids
+
+
+def run_rule_job(job_id):
+    job = TagRuleJob.objects.select_related('user').get(id=job_id)
+    job.status = TagRuleJob.RUNNING
+    job.claimed_until = timezone.now() + RULE_JOB_LEASE
+    job.save(update_fields=['status', 'claimed_until'])
+
+    try:
+        if job.matched <= RULE_JOB_CHUNK_SIZE:
+            with atomic():
+                job.processed = apply_rule_job(job, rule_job_transactions(job))
+        else:
+            # Every chunk renews the lease, and a job recovered after a crash
+            # resumes with the rows its chunks have not changed yet.
+            last_id = 0
+            while True:
+                chunk = list(rule_job_transactions(job).filter(id__gt=last_id)
+                             .order_by('id').values_list('id', flat=True)[:RULE_JOB_CHUNK_SIZE])
+                if not chunk:
+                    break
+                with atomic():
+                    job.processed += apply_rule_job(job, Transaction.objects.filter(id__in=chunk))
+                job.claimed_until = timezone.now() + RULE_JOB_LEASE
+                job.save(update_fields=['processed', 'claimed_until'])
+                last_id = chunk[-1]
+
+        job.status = TagRuleJob.DONE
+    except Exception as error:
+        logging.log(logging.ERROR, f"Tag rule job {job.id} failed: {error}")
+        job.status = TagRuleJob.FAILED
+        job.error = str(error)
+    finally:
+        job.finished = timezone.now()
+        job.claimed_until = None
+        job.save(update_fields=['status', 'processed', 'error', 'finished', 'claimed_until'])
+
+    return job
+
+
+def apply_rule_job(job, transactions):
+    months = reports.months_of(transactions)
+    transaction_ids = list(transactions.values_list('id', flat=True))
+
+    if job.action == TagRuleJob.APPLY:
+        processed = Transaction.objects.filter(id__in=transaction_ids).update(tag_id=job.tag_id, tagged_by_rule=True)
+    else:
+        # The rule is already deleted, so clearing the rule-assigned tag and
+        # re-running the remaining rules leaves each row with whatever they
+        # now assign. Tags set by hand are never selected.
+        Transaction.objects.filter(id__in=transaction_ids).update(tag=None, tagged_by_rule=False)
+        apply_rules(job.user, Transaction.objects.filter(id__in=transaction_ids))
+        processed = len(transaction_ids)
+
+    reports.refresh_months(job.user_id, months)
+    changes.record(job.user_id, ChangeEvent.TRANSACTION, transaction_ids)
+
+    return processed
@@ -1,3 +1,1127 @@
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import threading
+import time
+from unittest import mock
+
+import httpx
+import numpy as np
+import requests
+from asgiref.sync import async_to_sync
+from django.core.management import CommandError, call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from tx_app import analytics, changes, models, nordigen, nordigen_async, reports, response_cache, scheduler, tag_tree, tagging, token_store, TransactionHelper
+
+
+def create_account(user, name='Current', type_code='CURRENT'):
+    institution, created = models.Institution.objects.get_or_create(name='Bank', logo_url='', code='BANK')
+    account_type, created = models.AccountType.objects.get_or_create(code=type_code, description=type_code)
+    return models.Account.objects.create(resource_id=name, name=name, user=user, institution=institution, type=account_type)
+
+
+def booked_transaction(internal_id, amount, booking_date='2023-01-10', reference='REF'):
+    return {
+        'internalTransactionId': internal_id,
+        'bookingDate': booking_date,
+        'bookingDateTime': f'{booking_date}T12:00:00Z',
+        'transactionAmount': {'amount': str(amount), 'currency': 'GBP'},
+        'remittanceInformationUnstructured': reference,
+    }
+
+
+class SaveTransactionsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = models.User.objects.create_user('ingest', None, 'password')
+        self.account = create_account(self.user)
+
+    def test_inserts_in_batches(self):
+        result = self.account.save_transactions([booked_transaction(str(i), -i) for i in range(1, 8)], batch_size=3)
+
+        self.assertEqual(result.inserted, 7)
+        self.assertEqual(models.Transaction.objects.filter(account=self.account).count(), 7)
+
+    def test_counts_duplicates_and_rejected_rows(self):
+        self.account.save_transactions([booked_transaction('a', -1)])
+
+        rejected = booked_transaction('c', -3)
+        del rejected['bookingDateTime']
+        result = self.account.save_transactions([booked_transaction('a', -1), booked_transaction('b', -2),
+                                                 booked_transaction('b', -2), rejected])
+
+        self.assertEqual((result.inserted, result.duplicates, result.rejected), (1, 2, 1))
+        self.assertEqual(result.errors[0]['internalTransactionId'], 'c')
+        self.assertEqual(models.Transaction.objects.filter(account=self.account).count(), 2)
+
+    def test_rejects_over_long_values_before_insert(self):
+        result = self.account.save_transactions([booked_transaction('a', -1, reference='x' * 201),
+                                                 booked_transaction('b', -2)])
+
+        self.assertEqual((result.inserted, result.rejected), (1, 1))
+        self.assertEqual(result.errors[0]['internalTransactionId'], 'a')
+
+    def test_failed_batch_falls_back_to_single_rows(self):
+        self.account.save_transactions([booked_transaction('a', -1)])
+
+        # A concurrent run inserting 'a' after the duplicate lookup.
+        with mock.patch('tx_app.ingestion.existing_internal_ids', return_value=set()):
+            result = self.account.save_transactions([booked_transaction('a', -1), booked_transaction('b', -2)])
+
+        self.assertEqual((result.inserted, result.duplicates, result.rejected), (1, 1, 0))
+        self.assertEqual(result.transaction_ids, [models.Transaction.objects.get(internal_transaction_id='b').id])
+
+    def test_tags_new_transactions_with_one_update_per_tag(self):
+        groceries = models.Tag.objects.create(name='Groceries')
+        transport = models.Tag.objects.create(name='Transport')
+        models.TagRule.objects.create(user=self.user, tag=groceries, expression='tesco')
+        models.TagRule.objects.create(user=self.user, tag=transport, expression='tfl')
+
+        result = self.account.save_transactions([booked_transaction('a', -1, reference='TESCO 1'),
+                                                 booked_transaction('b', -2, reference='Tesco 2'),
+                                                 booked_transaction('c', -3, reference='TFL TRAVEL'),
+                                                 booked_transaction('d', -4, reference='OTHER')])
+
+        self.assertEqual(result.tagged, 3)
+        tags = dict(models.Transaction.objects.values_list('internal_transaction_id', 'tag_id'))
+        self.assertEqual(tags, {'a': groceries.id, 'b': groceries.id, 'c': transport.id, 'd': None})
+
+
+class TransactionsWatermarkTestCase(TestCase):
+
+    def setUp(self):
+        self.user = models.User.objects.create_user('watermark', None, 'password')
+        self.account = create_account(self.user)
+
+    def test_no_watermark_before_first_collection(self):
+        self.assertIsNone(self.account.transactions_watermark())
+
+    def test_watermark_is_latest_booking_date_minus_overlap(self):
+        self.account.save_transactions([booked_transaction('a', -1, '2023-01-10'),
+                                        booked_transaction('b', -1, '2023-02-20')])
+
+        self.assertEqual(self.account.transactions_watermark(3), datetime.date(2023, 2, 17))
+
+
+class SchedulerTestCase(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.users = [models.User.objects.create_user(f'scheduler{i}', None, 'password') for i in range(2)]
+        self.stale = create_account(self.users[0], 'Stale')
+        self.stale.last_collected_transactions = self.now - datetime.timedelta(days=2)
+        self.stale.save()
+        self.never = create_account(self.users[1], 'Never')
+        self.fresh = create_account(self.users[1], 'Fresh')
+        self.fresh.last_collected_transactions = self.now
+        self.fresh.save()
+
+    def test_due_accounts_are_ordered_by_staleness(self):
+        self.assertEqual(list(scheduler.due_accounts(self.now)), [self.never, self.stale])
+
+    def test_shards_do_not_overlap(self):
+        shards = [set(scheduler.due_accounts(self.now, force=True, shard=(index, 2))) for index in range(2)]
+
+        self.assertEqual(shards[0] | shards[1], {self.stale, self.never, self.fresh})
+        self.assertEqual(shards[0] & shards[1], set())
+
+    def test_claimed_accounts_are_not_claimed_again(self):
+        claimed = scheduler.claim_accounts(self.now, limit=1)
+
+        self.assertEqual(claimed, [self.never])
+        self.assertEqual(scheduler.claim_accounts(self.now), [self.stale])
+
+        scheduler.release_accounts(claimed)
+        self.assertEqual(scheduler.claim_accounts(self.now), [self.never])
+
+    def test_invalid_shard_reports_the_reason(self):
+        with self.assertRaisesMessage(CommandError, 'Shard index must be between 0 and 1, got: 2/2'):
+            call_command('fetch_transactions', '--shard', '2/2')
+
+
+class FetchTransactionsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = models.User.objects.create_user('fetch', None, 'password')
+        self.accounts = [create_account(self.user, name) for name in ('Good', 'Broken', 'Other')]
+
+    @staticmethod
+    def get_transactions(resource_id, date_from=None):
+        if resource_id == 'Broken':
+            return {'detail': 'unexpected payload'}
+        return {'transactions': {'booked': [booked_transaction(resource_id, -1)]}}
+
+    def test_failing_account_does_not_abort_the_run(self):
+        with mock.patch.object(nordigen, 'get_transactions', self.get_transactions), \
+                mock.patch.object(nordigen, 'get_account_balance', return_value='10.0'), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            call_command('fetch_transactions', workers=1)
+
+        self.assertEqual(set(models.Transaction.objects.values_list('internal_transaction_id', flat=True)), {'Good', 'Other'})
+        self.assertIn("Broken : failed: 'transactions'", output.getvalue())
+        self.assertFalse(models.Account.objects.filter(collection_claimed_until__isnull=False).exists())
+
+
+def nordigen_response(status_code, data=None, headers=None):
+    return mock.Mock(status_code=status_code, text=json.dumps(data or {}), headers=headers or {})
+
+
+class NordigenClientTestCase(TestCase):
+
+    def setUp(self):
+        self.client = nordigen.NordigenClient(max_retries=2, backoff_factor=0.01)
+        patcher = mock.patch.object(nordigen.Auth, 'get_headers', return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('tx_app.nordigen.time.sleep')
+    def test_retries_server_errors_and_honours_retry_after(self, sleep):
+        balances = {'balances': [{'balanceAmount': {'amount': '12.50'}}]}
+        with mock.patch.object(self.client.session, 'request', side_effect=[
+            nordigen_response(429, headers={'Retry-After': '2'}),
+            nordigen_response(503),
+            nordigen_response(200, balances),
+        ]):
+            self.assertEqual(self.client.get_account_balance('account'), '12.50')
+
+        self.assertEqual(sleep.call_args_list[0], mock.call(2.0))
+        self.assertEqual(self.client.stats()['account/balances']['calls'], 3)
+        self.assertEqual(self.client.stats()['account/balances']['retries'], 2)
+
+    @mock.patch('tx_app.nordigen.time.sleep')
+    def test_gives_up_after_max_retries(self, sleep):
+        with mock.patch.object(self.client.session, 'request', return_value=nordigen_response(500)) as request:
+            response = self.client.request("GET", "institutions", nordigen.Endpoint.INSTITUTIONS)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(self.client.stats()['institutions']['failures'], 1)
+
+    @mock.patch('tx_app.nordigen.time.sleep')
+    def test_posts_are_not_retried_once_they_may_have_been_processed(self, sleep):
+        with mock.patch.object(self.client.session, 'request', return_value=nordigen_response(503)) as request:
+            self.client.request("POST", "requisitions", nordigen.Endpoint.REQUISITIONS)
+        self.assertEqual(request.call_count, 1)
+
+        with mock.patch.object(self.client.session, 'request', side_effect=requests.exceptions.ReadTimeout()) as request:
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                self.client.request("POST", "requisitions", nordigen.Endpoint.REQUISITIONS)
+        self.assertEqual(request.call_count, 1)
+
+    @mock.patch('tx_app.nordigen.time.sleep')
+    def test_posts_are_retried_when_never_processed(self, sleep):
+        with mock.patch.object(self.client.session, 'request', side_effect=[
+            requests.exceptions.ConnectTimeout(),
+            nordigen_response(429),
+            nordigen_response(201),
+        ]) as request:
+            response = self.client.request("POST", "requisitions", nordigen.Endpoint.REQUISITIONS)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(request.call_count, 3)
+
+
+class AuthTestCase(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(nordigen.Auth, 'store', token_store.MemoryTokenStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrent_requests_share_one_token_request(self):
+        def request_tokens():
+            time.sleep(0.1)
+            return token_store.Token('access', 3600), token_store.Token('refresh', 7200)
+
+        with mock.patch.object(nordigen.Auth, 'request_tokens', side_effect=request_tokens) as requested:
+            threads = [threading.Thread(target=nordigen.Auth.get_access_token) for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(requested.call_count, 1)
+
+    def test_token_close_to_expiry_is_refreshed_in_the_background(self):
+        nordigen.Auth.store.save(token_store.Token('old', 60), token_store.Token('refresh', 7200))
+
+        with mock.patch.object(nordigen.Auth, 'refresh_access_token', return_value=token_store.Token('new', 3600)):
+            self.assertEqual(str(nordigen.Auth.get_access_token()), 'old')
+            with nordigen.Auth._background_refresh:
+                pass
+
+        self.assertEqual(str(nordigen.Auth.get_access_token()), 'new')
+
+
+class TokenStoreTestCase(TestCase):
+
+    def test_lock_is_not_entered_while_another_owner_holds_it(self):
+        for store in (token_store.CacheTokenStore(), token_store.DatabaseTokenStore()):
+            self.assertTrue(store.acquire('other'))
+            with mock.patch.object(token_store, 'LOCK_TIMEOUT_SECONDS', 0.2):
+                with self.assertRaises(token_store.TokenLockTimeout):
+                    with store.lock():
+                        self.fail("entered a lock held by another owner")
+            store.release('other')
+
+    def test_release_leaves_a_lease_taken_over_by_another_owner(self):
+        for store in (token_store.CacheTokenStore(), token_store.DatabaseTokenStore()):
+            self.assertTrue(store.acquire('other'))
+            store.release('mine')
+            self.assertFalse(store.acquire('mine'))
+
+            store.release('other')
+            self.assertTrue(store.acquire('mine'))
+            store.release('mine')
+
+
+class AsyncNordigenClientTestCase(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(nordigen.Auth, 'get_headers', return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_linked_account_details_are_fetched_concurrently(self):
+        requests_in_flight, max_in_flight = 0, 0
+
+        async def handler(request):
+            nonlocal requests_in_flight, max_in_flight
+            requests_in_flight += 1
+            max_in_flight = max(max_in_flight, requests_in_flight)
+            await asyncio.sleep(0.05)
+            requests_in_flight -= 1
+
+            resource_id = request.url.path.split('/')[-3]
+            if '/requisitions/' in request.url.path:
+                requisition_id = request.url.path.split('/')[-1]
+                return httpx.Response(200, json={'id': requisition_id, 'redirect': '', 'status': 'LN', 'link': '', 'reference': 1,
+                                                 'accounts': [f'{requisition_id}-1', f'{requisition_id}-2']})
+            return httpx.Response(200, json={'account': {'resourceId': resource_id, 'currency': 'GBP', 'cashAccountType': 'CACC'}})
+
+        client = nordigen_async.AsyncNordigenClient(transport=httpx.MockTransport(handler))
+        linked_accounts = async_to_sync(nordigen_async.get_linked_accounts)(['a', 'b'], client)
+
+        self.assertEqual([account_id for account_id, details in linked_accounts['b']], ['b-1', 'b-2'])
+        self.assertIsInstance(linked_accounts['a'][0][1], nordigen.Account)
+        self.assertEqual(max_in_flight, 4)
+
+    def test_failed_requisitions_and_accounts_are_left_out(self):
+        def handler(request):
+            if request.url.path.endswith('/requisitions/b'):
+                return httpx.Response(404, json={'detail': 'Not found.'})
+            if '/requisitions/' in request.url.path:
+                return httpx.Response(200, json={'id': 'a', 'redirect': '', 'status': 'LN', 'link': '', 'reference': 1,
+                                                 'accounts': ['a-1', 'a-2']})
+            if '/a-2/' in request.url.path:
+                return httpx.Response(404, json={'detail': 'Not found.'})
+            return httpx.Response(200, json={'account': {'resourceId': 'a-1', 'currency': 'GBP', 'cashAccountType': 'CACC'}})
+
+        client = nordigen_async.AsyncNordigenClient(transport=httpx.MockTransport(handler), max_retries=0)
+        with self.assertLogs(level='ERROR'):
+            linked_accounts = async_to_sync(nordigen_async.get_linked_accounts)(['a', 'b'], client)
+
+        self.assertEqual({requisition_id: [account_id for account_id, details in accounts]
+                          for requisition_id, accounts in linked_accounts.items()}, {'a': ['a-1']})
+
+
+class FindLinksTestCase(TestCase):
+
+    def setUp(self):
+        self.user = models.User.objects.create_user('links', None, 'password')
+        self.current = create_account(self.user, 'Current')
+        self.savings = create_account(self.user, 'Savings', 'SAVINGS')
+
+    def test_links_opposite_amounts_across_accounts_on_the_same_day(self):
+        self.current.save_transactions([booked_transaction('c1', -50), booked_transaction('c2', -20),
+                                        booked_transaction('c3', 20)])
+        self.savings.save_transactions([booked_transaction('s1', 50), booked_transaction('s2', 20, '2023-01-11')])
+
+        # Matching costs three queries however many rows there are; the
+        # rollup refresh and change feed are pinned in their own tests.
+        with mock.patch.object(reports, 'refresh_months'), mock.patch.object(changes, 'record'):
+            with self.assertNumQueries(3):
+                TransactionHelper.find_links(self.user, window_days=0)
+
+        links = models.TransactionLink.objects.values_list('from_transaction__internal_transaction_id',
+                                                           'to_transaction__internal_transaction_id')
+        self.assertEqual(list(links), [('c1', 's1')])
+
+    def test_linked_transactions_are_not_linked_again(self):
+        self.current.save_transactions([booked_transaction('c1', -50), booked_transaction('c2', -50)])
+        self.savings.save_transactions([booked_transaction('s1', 50), booked_transaction('s2', 50)])
+
+        TransactionHelper.find_links(self.user)
+        TransactionHelper.find_links(self.user)
+
+        self.assertEqual(models.TransactionLink.objects.count(), 2)
+
+    def test_incremental_links_only_involve_new_transactions(self):
+        self.current.save_transactions([booked_transaction('c1', -50), booked_transaction('c2', -30, '2023-01-12')])
+        self.savings.save_transactions([booked_transaction('s1', 50)])
+
+        result = self.savings.save_transactions([booked_transaction('s2', 30, '2023-01-12')])
+        TransactionHelper.find_links_for(self.user, result.transaction_ids)
+
+        links = models.TransactionLink.objects.values_list('from_transaction__internal_transaction_id',
+                                                           'to_transaction__internal_transaction_id')
+        self.assertEqual(list(links), [('c2', 's2')])
+
+    def test_picks_the_closest_counterpart_within_the_window(self):
+        self.current.save_transactions([booked_transaction('c1', -100, '2023-01-10'),
+                                        booked_transaction('c2', -100, '2023-01-20')])
+        self.savings.save_transactions([booked_transaction('s1', 100, '2023-01-12'),
+                                        booked_transaction('s2', 99.5, '2023-01-20'),
+                                        booked_transaction('s3', 100, '2023-01-30')])
+
+        TransactionHelper.find_links(self.user, window_days=3, amount_tolerance=1)
+
+        links = models.TransactionLink.objects.order_by('confidence').values_list(
+            'from_transaction__internal_transaction_id', 'to_transaction__internal_transaction_id', 'confidence')
+        self.assertEqual(list(links), [('c1', 's1', 0.5), ('c2', 's2', 0.75)])
+
+    def test_same_amount_rows_are_only_compared_inside_the_window(self):
+        start = datetime.date(2023, 1, 1)
+        candidates = [TransactionHelper.LinkCandidate(day * 2 + side, side, start + datetime.timedelta(days=day),
+                                                      50 if side else -50, 'REF')
+                      for day in range(1000) for side in (0, 1)]
+
+        with mock.patch.object(TransactionHelper, 'match_confidence', wraps=TransactionHelper.match_confidence) as scored:
+            matches = TransactionHelper.match_candidates(candidates, window_days=1)
+
+        self.assertEqual(len(matches), 1000)
+        self.assertTrue(all(match.from_transaction.booking_date == match.to_transaction.booking_date for match in matches))
+        self.assertLessEqual(scored.call_count, 3 * 1000)
+
+
+class RuleMatcherTestCase(TestCase):
+
+    def test_matches_case_insensitively_with_the_oldest_rule_winning(self):
+        matcher = tagging.RuleMatcher([(3, 'tesco', 30), (1, 'TESCO EXPRESS', 10), (2, 'she', 20), (4, 'he', 40)])
+
+        self.assertEqual(matcher.match('Card payment Tesco Express London'), 10)
+        self.assertEqual(matcher.match('TESCO STORES'), 30)
+        self.assertEqual(matcher.match('ushers'), 20)
+        self.assertEqual(matcher.match('the'), 40)
+        self.assertIsNone(matcher.match('Sainsburys'))
+
+    def test_matcher_is_rebuilt_when_rules_change(self):
+        user = models.User.objects.create_user('rules', None, 'password')
+        tag = models.Tag.objects.create(name='Groceries')
+        models.TagRule.objects.create(user=user, tag=tag, expression='tesco')
+
+        matcher = tagging.get_matcher(user)
+        self.assertIs(tagging.get_matcher(user), matcher)
+
+        models.TagRule.objects.create(user=user, tag=tag, expression='aldi')
+        self.assertEqual(tagging.get_matcher(user).match('ALDI 123'), tag.id)
+
+    @mock.patch.object(tagging, 'MATCHER_CACHE_SIZE', 2)
+    def test_least_recently_used_matcher_is_evicted(self):
+        users = [models.User.objects.create_user(f'lru{i}', None, 'password') for i in range(3)]
+
+        for user in (users[0], users[1], users[0], users[2]):
+            tagging.get_matcher(user)
+
+        self.assertEqual(list(tagging._matchers), [users[0].id, users[2].id])
+
+
+class TagRuleJobTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = models.User.objects.create_user('jobs', None, 'password')
+        self.account = create_account(self.user)
+        self.groceries = models.Tag.objects.create(name='Groceries')
+        self.account.save_transactions([booked_transaction('a', -1, reference='TESCO 1'),
+                                        booked_transaction('b', -2, reference='tesco 2'),
+                                        booked_transaction('c', -3, reference='ALDI')])
+
+    def tags(self):
+        return dict(models.Transaction.objects.values_list('internal_transaction_id', 'tag_id'))
+
+    def test_new_rule_is_applied_retroactively(self):
+        rule = models.TagRule.objects.create(user=self.user, tag=self.groceries, expression='Tesco')
+        job = tagging.enqueue_rule_job(self.user, rule.tag, rule.expression, models.TagRuleJob.APPLY)
+        self.assertEqual(job.matched, 2)
+
+        job = tagging.run_rule_job(job.id)
+
+        self.assertEqual((job.status, job.processed), (models.TagRuleJob.DONE, 2))
+        self.assertEqual(self.tags(), {'a': self.groceries.id, 'b': self.groceries.id, 'c': None})
+
+    @mock.patch('tx_app.tagging.RULE_JOB_CHUNK_SIZE', 1)
+    def test_deleted_rule_is_removed_in_chunks(self):
+        models.Transaction.objects.update(tag=self.groceries, tagged_by_rule=True)
+        job = tagging.enqueue_rule_job(self.user, self.groceries, 'tesco', models.TagRuleJob.REMOVE)
+
+        job = tagging.run_rule_job(job.id)
+
+        self.assertEqual(job.processed, 2)
+        self.assertEqual(self.tags(), {'a': None, 'b': None, 'c': self.groceries.id})
+
+    def test_deleted_rule_keeps_tags_set_by_hand(self):
+        rule = models.TagRule.objects.create(user=self.user, tag=self.groceries, expression='tesco')
+        tagging.run_rule_job(tagging.enqueue_rule_job(self.user, rule.tag, rule.expression, models.TagRuleJob.APPLY).id)
+        transaction = models.Transaction.objects.get(internal_transaction_id='b')
+        self.client.force_authenticate(self.user)
+        self.client.post('/transactions', {'transactionUpdates': [{'transactionId': transaction.id, 'tagId': self.groceries.id}]},
+                         format='json')
+
+        rule.delete()
+        job = tagging.run_rule_job(tagging.enqueue_rule_job(self.user, rule.tag, rule.expression, models.TagRuleJob.REMOVE).id)
+
+        self.assertEqual(job.processed, 1)
+        self.assertEqual(self.tags(), {'a': None, 'b': self.groceries.id, 'c': None})
+
+    def test_worker_picks_up_pending_and_abandoned_jobs(self):
+        rule = models.TagRule.objects.create(user=self.user, tag=self.groceries, expression='tesco')
+        pending = tagging.enqueue_rule_job(self.user, rule.tag, rule.expression, models.TagRuleJob.APPLY)
+        abandoned = tagging.enqueue_rule_job(self.user, rule.tag, 'aldi', models.TagRuleJob.APPLY)
+        models.TagRuleJob.objects.filter(id=abandoned.id).update(
+            status=models.TagRuleJob.RUNNING, claimed_until=timezone.now() - datetime.timedelta(minutes=1))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('run_rule_jobs')
+
+        self.assertEqual(set(models.TagRuleJob.objects.values_list('status', flat=True)), {models.TagRuleJob.DONE})
+        self.assertEqual(self.tags(), {'a': self.groceries.id, 'b': self.groceries.id, 'c': self.groceries.id})
+        self.assertEqual(tagging.claim_rule_jobs(timezone.now()), [])
+
+
+class ReportsTestCase(TestCase):
+
+    def setUp(self):
+        response_cache.cache.clear()
+        tag_tree.clear()
+        self.user = models.User.objects.create_user('reports', None, 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        self.savings_category = models.Category.objects.create(code='SAVINGS', name='Savings')
+        self.expenses = models.Category.objects.create(code='EXPENSES', name='Expenses')
+        self.food = models.Tag.objects.create(name='Food', category=self.expenses)
+        self.groceries = models.Tag.objects.create(name='Groceries', parent=self.food)
+        holiday = models.Holiday.objects.create(name='Trip', user=self.user, start_date=datetime.date(2023, 2, 1),
+                                                end_date=datetime.date(2023, 2, 10))
+
+        current = create_account(self.user, 'Current')
+        savings = create_account(self.user, 'Savings', 'SAVINGS')
+        current.save_transactions([booked_transaction('t1', -15, '2023-01-10'), booked_transaction('t2', -5, '2023-01-12'),
+                                   booked_transaction('t3', -7, '2023-02-01'), booked_transaction('t4', -100, '2023-02-03')])
+        savings.save_transactions([booked_transaction('s1', 100, '2023-02-03'), booked_transaction('s2', 3, '2023-02-05')])
+
+        self.update_transactions({'t1': {'tagId': self.groceries.id}, 't2': {'tagId': self.food.id},
+                                  's2': {'tagId': self.food.id, 'holidayId': holiday.id}})
+        TransactionHelper.find_links(self.user)
+
+    def update_transactions(self, updates):
+        ids = dict(models.Transaction.objects.values_list('internal_transaction_id', 'id'))
+        response = self.client.post('/transactions', {'transactionUpdates': [
+            dict(update, transactionId=ids[internal_id]) for internal_id, update in updates.items()
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def expected_month(self, untagged, savings, food, groceries):
+        return {
+            'untagged': untagged,
+            'SAVINGS': {'total': savings, 'categories': {}},
+            'EXPENSES': {'total': food, 'categories': {'Food': {
+                'tag': {'id': self.food.id, 'name': 'Food', 'icon': None, 'category': {'code': 'EXPENSES', 'name': 'Expenses'}},
+                'total': food,
+                'categories': {'Groceries': {'tag': {'id': self.groceries.id, 'name': 'Groceries', 'icon': None}, 'total': groceries}},
+            }}},
+        }
+
+    def expected_report(self):
+        year = self.expected_month(0, 103, -20, -15)
+        year['January'] = self.expected_month(0, 0, -20, -15)
+        year['February'] = self.expected_month(1, 103, 0, 0)
+        return {'2023': year}
+
+    def test_report_is_served_from_the_rollup(self):
+        self.assertEqual(models.MonthlySpend.objects.filter(user=self.user, year=2023, month=2).count(), 3)
+        self.assertEqual(self.client.get('/reports').json(), self.expected_report())
+
+    def test_rebuild_matches_incremental_rollup(self):
+        models.MonthlySpend.objects.all().delete()
+        reports.rebuild(self.user.id)
+
+        self.assertEqual(self.client.get('/reports').json(), self.expected_report())
+
+    def test_live_report_matches_the_rollup_with_a_constant_number_of_queries(self):
+        self.assertEqual(self.client.get('/reports?source=live').json(), self.expected_report())
+
+        with CaptureQueriesContext(connection) as small:
+            reports.live_report(self.user)
+
+        account = models.Account.objects.get(name='Current')
+        account.save_transactions([booked_transaction(f'extra{i}', -1, f'2022-{i % 12 + 1:02}-01') for i in range(50)])
+        models.Transaction.objects.filter(internal_transaction_id__startswith='extra').update(tag=self.groceries)
+
+        with CaptureQueriesContext(connection) as large:
+            reports.live_report(self.user)
+
+        self.assertEqual(len(small), len(large))
+        self.assertLessEqual(len(large), 3)
+
+    def test_columnar_report_matches_the_rollup(self):
+        self.assertEqual(self.client.get('/reports?source=columnar').json(), self.expected_report())
+
+    def test_refresh_reads_under_the_rollup_lock_in_a_fixed_number_of_queries(self):
+        # A savepoint, two to take the lock, then aggregate, delete, insert
+        # and release, however many months are refreshed.
+        with self.assertNumQueries(7):
+            reports.refresh_months(self.user.id, {(2023, 1), (2023, 2)})
+
+        self.assertEqual(self.client.get('/reports').json(), self.expected_report())
+
+    def test_moving_a_tag_recategorises_its_rollup_rows(self):
+        bills = models.Category.objects.create(code='BILLS', name='Bills')
+        models.Tag.objects.create(name='Household', category=bills)
+
+        response = self.client.post('/private/upload/tags', {'tags': [
+            {'name': 'Household', 'icon': None, 'childTags': [{'name': 'Groceries', 'icon': None}]},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        january = self.client.get('/reports').json()['2023']['January']
+        self.assertEqual(january['BILLS']['categories']['Household']['categories']['Groceries']['total'], -15)
+        self.assertEqual(january['EXPENSES']['total'], -5)
+
+
+class AnalyticsTestCase(TestCase):
+
+    def setUp(self):
+        response_cache.cache.clear()
+        self.user = models.User.objects.create_user('analytics', None, 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        travel = models.Tag.objects.create(name='Travel')
+        self.flights = models.Tag.objects.create(name='Flights', parent=travel)
+        self.hotels = models.Tag.objects.create(name='Hotels', parent=travel)
+        self.eating_out = models.Tag.objects.create(name='Eating Out')
+        self.holiday = models.Holiday.objects.create(name='Trip', user=self.user, start_date=datetime.date(2023, 2, 1),
+                                                     end_date=datetime.date(2023, 2, 10))
+        models.Holiday.objects.create(name='Empty', user=self.user, start_date=datetime.date(2022, 5, 1),
+                                      end_date=datetime.date(2022, 5, 3))
+
+        account = create_account(self.user)
+        account.save_transactions([booked_transaction('flight', -120.5, '2023-02-01'),
+                                   booked_transaction('hotel', -300.25, '2023-02-02'),
+                                   booked_transaction('dinner', -40.1, '2023-02-03'),
+                                   booked_transaction('refund', 20, '2023-02-04'),
+                                   booked_transaction('later', -10, '2024-02-04')])
+        tags = {'flight': self.flights, 'hotel': self.hotels, 'dinner': self.eating_out, 'later': self.flights}
+        for internal_id, tag in tags.items():
+            models.Transaction.objects.filter(internal_transaction_id=internal_id).update(tag=tag)
+        models.Transaction.objects.exclude(internal_transaction_id='later').update(holiday=self.holiday)
+
+        self.columns = analytics.TransactionColumns.for_user(self.user)
+
+    def test_grouped_percentiles_match_numpy(self):
+        values = np.array([5.0, 1.0, 3.0, 10.0, 2.0, 8.0, 4.0])
+        inverse = np.array([0, 0, 0, 1, 1, 2, 0])
+
+        result = analytics.grouped_percentiles(values, inverse, 4, (25, 50, 90))
+
+        for group in range(3):
+            np.testing.assert_allclose(result[group], np.percentile(values[inverse == group], (25, 50, 90)))
+        self.assertTrue(np.isnan(result[3]).all())
+
+    def test_time_series_rolling_average_and_year_over_year(self):
+        tags, first_month, series = analytics.tag_time_series(self.columns, top_level=True)
+
+        travel = list(tags).index(self.flights.parent_id)
+        self.assertEqual(first_month, (2023 - 1970) * 12 + 1)
+        self.assertEqual(series.shape, (len(tags), 13))
+        self.assertAlmostEqual(series[travel, 0], -420.75)
+        self.assertAlmostEqual(series[travel, 12], -10)
+
+        np.testing.assert_allclose(analytics.rolling_average(np.array([2.0, 4.0, 6.0, 8.0]), 2), [2, 3, 5, 7])
+        self.assertAlmostEqual(analytics.year_over_year(series)[travel, 12], (-10 + 420.75) / 420.75)
+
+    def test_rolling_average_rejects_an_empty_window(self):
+        for window in (0, -1):
+            with self.assertRaises(ValueError):
+                analytics.rolling_average(np.array([2.0, 4.0]), window)
+
+    def test_columnar_holiday_summaries_match_the_per_holiday_summary(self):
+        legacy = self.client.get('/holidays').json()
+        columnar = self.client.get('/holidays?source=columnar').json()
+
+        self.assertEqual(columnar, legacy)
+        trip = columnar['holidays'][0]['holidays'][0]
+        self.assertEqual((trip['total'], trip['travel'], trip['hotels'], trip['food']), (-440.85, -120.5, -300.25, -40.1))
+
+    def test_holiday_summaries_use_one_query_for_every_holiday(self):
+        for year in range(2010, 2020):
+            models.Holiday.objects.create(name=f'Trip {year}', user=self.user, start_date=datetime.date(year, 1, 1),
+                                          end_date=datetime.date(year, 1, 7))
+
+        # The response cache's version lookup is pinned in ResponseCacheTestCase,
+        # leaving the holidays and their summaries.
+        with mock.patch.object(models.UserDataVersion, 'current_with_global', return_value=(0, 0)):
+            with self.assertNumQueries(2):
+                response = self.client.get('/holidays')
+
+        self.assertEqual([group['year'] for group in response.json()['holidays']], [2023, 2022] + list(range(2010, 2020)))
+
+    def test_summary_buckets_are_configurable(self):
+        buckets = {'flights': {'tags': ['Flights']}, 'travel': {'parent': 'Travel'}}
+
+        with self.settings(HOLIDAY_SUMMARY_BUCKETS=buckets):
+            trip = self.client.get('/holidays').json()['holidays'][0]['holidays'][0]
+            columnar = self.client.get('/holidays?source=columnar').json()['holidays'][0]['holidays'][0]
+
+        self.assertEqual({key: trip[key] for key in ('total', 'flights', 'travel')},
+                         {'total': -440.85, 'flights': -120.5, 'travel': -420.75})
+        self.assertNotIn('food', trip)
+        self.assertEqual(columnar, trip)
+
+
+class ResponseCacheTestCase(TestCase):
+
+    def setUp(self):
+        response_cache.cache.clear()
+        tag_tree.clear()
+        self.user = models.User.objects.create_user('cache', None, 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_least_recently_used_entries_are_evicted_past_the_memory_cap(self):
+        cache = response_cache.ResponseCache(max_bytes=10)
+        cache.put((1, '/tags', 0), b'aaaa')
+        cache.put((2, '/tags', 0), b'bbbb')
+        cache.get((1, '/tags', 0))
+        cache.put((3, '/tags', 0), b'cccc')
+
+        self.assertIsNone(cache.get((2, '/tags', 0)))
+        self.assertEqual(cache.get((1, '/tags', 0)), b'aaaa')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        cache.put((1, '/tags', 1), b'dd')
+        self.assertIsNone(cache.get((1, '/tags', 0)))
+        self.assertEqual(cache.stats()['bytes'], 6)
+
+    def test_writes_bump_the_version_and_invalidate_cached_responses(self):
+        first = self.client.get('/tags').json()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/tags').json(), first)
+
+        self.client.put('/tags', {'name': 'Food', 'icon': 'food'}, format='json')
+
+        self.assertEqual([tag['name'] for tag in self.client.get('/tags').json()['tags']], ['Food'])
+        self.assertEqual(self.client.get('/cache/stats').status_code, 403)
+        admin = APIClient()
+        admin.force_authenticate(models.User.objects.create_user('admin', None, 'password', is_staff=True))
+        self.assertEqual(admin.get('/cache/stats').json()['hits'], 1)
+
+        account = create_account(self.user)
+        account.requisition = models.Requisition.objects.create(user=self.user, institution=account.institution,
+                                                                external_id='req', status='LINKED',
+                                                                expires=datetime.date.today())
+        account.save()
+        self.assertEqual(self.client.get('/transactions').json()['accounts'][0]['transactions'], [])
+
+        account.save_transactions([booked_transaction('t1', -5)])
+        accounts = self.client.get('/transactions').json()['accounts']
+        self.assertEqual(len(accounts[0]['transactions']), 1)
+
+    def test_renamed_institutions_refresh_every_cached_account(self):
+        account = create_account(self.user)
+        account.requisition = models.Requisition.objects.create(user=self.user, institution=account.institution,
+                                                                external_id='req', status='LINKED',
+                                                                expires=datetime.date.today())
+        account.save()
+        self.assertEqual(self.client.get('/transactions').json()['accounts'][0]['bankName'], 'Bank')
+
+        institution = nordigen.InstitutionData(id='BANK', name='New Bank', bic='BIC', transaction_total_days=90,
+                                               countries=['GB'], logo='logo.png')
+        with mock.patch.object(nordigen, 'get_institutions', return_value=[institution]):
+            self.assertEqual(self.client.get('/private/update/institutions').status_code, 200)
+
+        account_data = self.client.get('/transactions').json()['accounts'][0]
+        self.assertEqual((account_data['bankName'], account_data['logo']), ('New Bank', 'logo.png'))
+
+    def test_requisition_changes_and_a_new_day_refresh_cached_accounts(self):
+        account = create_account(self.user)
+        requisition = models.Requisition.objects.create(user=self.user, institution=account.institution,
+                                                        external_id='req', status='LINKED',
+                                                        expires=datetime.date.today() + datetime.timedelta(days=1))
+        account.requisition = requisition
+        account.save()
+        self.assertFalse(self.client.get('/transactions').json()['accounts'][0]['expired'])
+
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        next_day = mock.Mock(date=mock.Mock(today=lambda: tomorrow))
+        with mock.patch('tx_app.response_cache.datetime', next_day), mock.patch('tx_app.fast_serialize.datetime', next_day):
+            self.assertTrue(self.client.get('/transactions').json()['accounts'][0]['expired'])
+
+        self.client.patch('/requisition', {'clientRef': requisition.id, 'status': 'ACTIVE'}, format='json')
+        account_data = self.client.get('/transactions').json()['accounts'][0]
+        self.assertEqual(account_data['expires'], str(datetime.date.today() + datetime.timedelta(days=89)))
+
+
+class TransactionPagesTestCase(TestCase):
+
+    def setUp(self):
+        response_cache.cache.clear()
+        tag_tree.clear()
+        self.user = models.User.objects.create_user('pages', None, 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        self.current = create_account(self.user, 'Current')
+        self.savings = create_account(self.user, 'Savings', 'SAVINGS')
+        self.current.save_transactions([booked_transaction(f'c{day}', -day, f'2023-01-{day:02}') for day in range(1, 11)])
+        self.savings.save_transactions([booked_transaction('s1', 5, '2023-01-05')])
+
+    def page(self, **params):
+        response = self.client.get('/transactions', params)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [transaction['reference'] for transaction in data['transactions']], data['nextCursor']
+
+    def test_cursor_walks_every_transaction_newest_first(self):
+        models.Transaction.objects.update(reference=models.models.F('internal_transaction_id'))
+
+        seen = []
+        references, cursor = self.page(limit=4)
+        while True:
+            seen += references
+            if cursor is None:
+                break
+            references, cursor = self.page(limit=4, cursor=cursor)
+
+        self.assertEqual(seen, ['c10', 'c9', 'c8', 'c7', 'c6', 's1', 'c5', 'c4', 'c3', 'c2', 'c1'])
+
+    def test_filters_by_date_range_and_account(self):
+        models.Transaction.objects.update(reference=models.models.F('internal_transaction_id'))
+
+        self.assertEqual(self.page(**{'from': '2023-01-04', 'to': '2023-01-05'}), (['s1', 'c5', 'c4'], None))
+        self.assertEqual(self.page(**{'from': '2023-01-04', 'to': '2023-01-05', 'account': self.current.id}), (['c5', 'c4'], None))
+
+    def test_pages_are_read_by_user_and_checked_against_the_account_owner(self):
+        self.assertEqual(set(models.Transaction.objects.values_list('user_id', flat=True)), {self.user.id})
+
+        with CaptureQueriesContext(connection) as queries:
+            self.page(limit=4)
+
+        page_query = next(query['sql'] for query in queries if 'FROM "tx_app_transaction"' in query['sql'])
+        self.assertIn('"tx_app_transaction"."user_id" =', page_query)
+
+        # A row whose user was filled in wrongly is never served to that user.
+        other = models.User.objects.create_user('pagesother', None, 'password')
+        models.Transaction.objects.filter(account=self.savings).update(user=other)
+        other_client = APIClient()
+        other_client.force_authenticate(other)
+        self.assertEqual(other_client.get('/transactions', {'limit': 4}).json()['transactions'], [])
+
+    def test_invalid_parameters_are_rejected(self):
+        self.assertEqual(self.client.get('/transactions', {'cursor': 'nonsense'}).status_code, 400)
+        self.assertEqual(self.client.get('/transactions', {'from': '2023-13-01'}).status_code, 400)
+        self.assertEqual(self.client.get('/transactions', {'limit': 0}).status_code, 400)
+
+
+class ChangesTestCase(TestCase):
+
+    def setUp(self):
+        self.user = models.User.objects.create_user('changes', None, 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.current = create_account(self.user, 'Current')
+        self.savings = create_account(self.user, 'Savings', 'SAVINGS')
+
+    def changes(self, since):
+        response = self.client.get('/changes', {'since': since})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_returns_only_changes_after_the_cursor(self):
+        self.current.save_transactions([booked_transaction('c1', -50), booked_transaction('c2', -10)])
+        sequence = self.client.get('/changes').json()['sequence']
+
+        self.savings.save_transactions([booked_transaction('s1', 50)])
+        TransactionHelper.find_links(self.user)
+        self.client.put('/tags', {'name': 'Food', 'icon': 'food'}, format='json')
+
+        feed = self.changes(sequence)
+
+        ids = dict(models.Transaction.objects.values_list('internal_transaction_id', 'id'))
+        self.assertEqual([transaction['transactionId'] for transaction in feed['upserts']['transactions']], [ids['s1']])
+        self.assertEqual([(link['fromTransactionId'], link['toTransactionId']) for link in feed['upserts']['links']],
+                         [(ids['c1'], ids['s1'])])
+        self.assertEqual([tag['name'] for tag in feed['upserts']['tags']], ['Food'])
+        self.assertEqual(self.changes(feed['sequence']), {'sequence': feed['sequence'], 'globalSequence': 0,
+                                                          'upserts': {'transactions': [], 'links': [], 'tags': [], 'rules': []},
+                                                          'deletes': {'transactions': [], 'links': [], 'tags': [], 'rules': []}})
+
+    def test_global_tag_edits_are_recorded_once_for_every_user(self):
+        other = APIClient()
+        other.force_authenticate(models.User.objects.create_user('other', None, 'password'))
+        tag = models.Tag.objects.create(name='Travel')
+        self.client.patch('/tags', {'tagId': tag.id, 'name': 'Holidays'}, format='json')
+        cached = self.client.get('/tags').json()
+        start = self.client.get('/changes').json()
+
+        # Load and save the tag, then bump the global version, read it back
+        # and upsert the event, however many users there are.
+        with self.assertNumQueries(5):
+            self.client.patch('/tags', {'tagId': tag.id, 'name': 'Trips'}, format='json')
+
+        self.assertFalse(models.ChangeEvent.objects.exists())
+        self.assertNotEqual(self.client.get('/tags').json(), cached)
+        for client in (self.client, other):
+            feed = client.get('/changes', {'since': start['sequence'], 'globalSince': start['globalSequence']}).json()
+            self.assertEqual([tag['name'] for tag in feed['upserts']['tags']], ['Trips'])
+            self.assertEqual(feed['globalSequence'], start['globalSequence'] + 1)
+
+        latest = client.get('/changes', {'since': feed['sequence'], 'globalSince': feed['globalSequence']}).json()
+        self.assertEqual(latest['upserts']['tags'], [])
+
+    def test_deleted_rules_are_reported_as_deletes(self):
+        tag = models.Tag.objects.create(name='Food', user=self.user)
+        rule_id = self.client.put('/rules', {'tagId': tag.id, 'expression': 'shop'}, format='json').json()['ruleId']
+        sequence = self.changes(0)['sequence']
+        self.assertEqual(self.changes(0)['upserts']['rules'], [{'id': rule_id, 'expression': 'shop', 'tagId': tag.id}])
+
+        self.client.delete('/rules', {'ruleId': rule_id}, format='json')
+
+        feed = self.changes(sequence)
+        self.assertEqual(feed['upserts']['rules'], [])
+        self.assertEqual(feed['deletes']['rules'], [rule_id])
+
+
+class FastSerializeTestCase(TestCase):
+
+    def setUp(self):
+        response_cache.cache.clear()
+        tag_tree.clear()
+        self.user = models.User.objects.create_user('serialize', None, 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        expenses = models.Category.objects.create(code='EXPENSES', name='Expenses')
+        food = models.Tag.objects.create(name='Food', category=expenses)
+        groceries = models.Tag.objects.create(name='Groceries', parent=food)
+        own = models.Tag.objects.create(name='Own', user=self.user, icon='star')
+        holiday = models.Holiday.objects.create(name='Trip', user=self.user, start_date=datetime.date(2023, 1, 1),
+                                                end_date=datetime.date(2023, 1, 20), img_url='img')
+
+        for name, type_code in (('Current', 'CURRENT'), ('Savings', 'SAVINGS')):
+            account = create_account(self.user, name, type_code)
+            account.requisition = models.Requisition.objects.create(user=self.user, institution=account.institution,
+                                                                    external_id=name, status='LINKED',
+                                                                    expires=datetime.date(2023, 3, 1))
+            account.colour = 'red' if type_code == 'SAVINGS' else None
+            account.save()
+            account.save_transactions([booked_transaction(f'{name}{i}', (i + 0.25) * (1 if type_code == 'SAVINGS' else -1),
+                                                          f'2023-01-{i + 1:02}') for i in range(5)])
+
+        models.Transaction.objects.filter(internal_transaction_id='Current1').update(tag=groceries, holiday=holiday)
+        models.Transaction.objects.filter(internal_transaction_id='Current2').update(tag=food)
+        models.Transaction.objects.filter(internal_transaction_id='Savings3').update(tag=own, holiday=holiday)
+        TransactionHelper.find_links(self.user)
+
+    def test_matches_the_model_serializer_byte_for_byte(self):
+        legacy = self.client.get('/transactions', {'serializer': 'legacy'}).content
+        fast = self.client.get('/transactions').content
+
+        self.assertEqual(len(json.loads(fast)['links']), 5)
+        self.assertEqual(fast, legacy)
+
+    def test_query_count_does_not_grow_with_history(self):
+        from tx_app import fast_serialize
+
+        fast_serialize.transactions(self.user)
+        with self.assertNumQueries(6):
+            fast_serialize.transactions(self.user)
+
+    def test_streamed_response_matches_and_arrives_in_chunks(self):
+        create_account(self.user, 'Empty')
+        fast = self.client.get('/transactions').content
+
+        with mock.patch('tx_app.fast_serialize.STREAM_BUFFER_BYTES', 500):
+            response = self.client.get('/transactions', {'stream': '1'})
+            chunks = list(response.streaming_content)
+
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(b''.join(chunks), fast)
+
+
+class TagTreeTestCase(TestCase):
+
+    def setUp(self):
+        response_cache.cache.clear()
+        tag_tree.clear()
+        self.user = models.User.objects.create_user('tree', None, 'password')
+        self.other = models.User.objects.create_user('other', None, 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        food = models.Tag.objects.create(name='Food')
+        for i in range(10):
+            models.Tag.objects.create(name=f'Food {i}', parent=food)
+        models.Tag.objects.create(name='Secret', parent=food, user=self.other)
+
+    def test_tree_is_loaded_in_constant_queries_and_cached_until_tags_change(self):
+        with self.assertNumQueries(4):
+            tree = tag_tree.get(self.user)
+        self.assertEqual([tag.name for tag in tree.children[tree.tags[0].id]], [f'Food {i}' for i in range(10)])
+
+        with self.assertNumQueries(1):
+            self.assertIs(tag_tree.get(self.user), tree)
+
+        food = tree.tags[0]
+        self.client.put('/tags', {'name': 'Snacks', 'icon': 'snack', 'parentTag': food.id}, format='json')
+        self.client.put('/rules', {'tagId': food.id, 'expression': 'cafe'}, format='json')
+
+        data = self.client.get('/tags').json()
+        self.assertEqual(data['tags'][0]['childTags'][-1]['name'], 'Snacks')
+        self.assertEqual(data['tags'][0]['rules'], [{'id': models.TagRule.objects.get().id, 'expression': 'cafe'}])
+
+    @mock.patch.object(tag_tree, 'TREE_CACHE_SIZE', 2)
+    def test_least_recently_used_tree_is_evicted(self):
+        third = models.User.objects.create_user('third', None, 'password')
+
+        for user in (self.user, self.other, self.user, third):
+            tag_tree.get(user)
+
+        self.assertEqual(list(tag_tree._trees), [self.user.id, third.id])
+
+
+class BulkTransactionUpdateTestCase(TestCase):
+
+    def setUp(self):
+        response_cache.cache.clear()
+        self.user = models.User.objects.create_user('bulk', None, 'password')
+        self.other = models.User.objects.create_user('bulkother', None, 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        self.food = models.Tag.objects.create(name='Food')
+        self.private = models.Tag.objects.create(name='Private', user=self.other)
+        self.holiday = models.Holiday.objects.create(name='Trip', user=self.user, start_date=datetime.date(2023, 1, 1),
+                                                     end_date=datetime.date(2023, 1, 20))
+        create_account(self.user).save_transactions(
+            [booked_transaction(f't{i}', -i - 1, f'2023-{i % 12 + 1:02}-05') for i in range(50)])
+        self.ids = list(models.Transaction.objects.order_by('id').values_list('id', flat=True))
+
+    def post(self, updates):
+        return self.client.post('/transactions', {'transactionUpdates': updates}, format='json')
+
+    def test_updates_are_applied_with_a_constant_number_of_queries(self):
+        def run(ids):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post([{'transactionId': transaction_id, 'tagId': self.food.id, 'holidayId': self.holiday.id}
+                                      for transaction_id in ids])
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        self.assertEqual(run(self.ids[:24]), run(self.ids[24:]))
+        self.assertEqual(models.Transaction.objects.filter(tag=self.food, holiday=self.holiday).count(), 50)
+        self.assertEqual(models.MonthlySpend.objects.filter(user=self.user, tag=self.food).count(), 12)
+
+    def test_invalid_items_reject_the_whole_batch(self):
+        response = self.post([{'transactionId': self.ids[0], 'tagId': self.food.id},
+                              {'transactionId': self.ids[1], 'tagId': self.private.id},
+                              {'transactionId': 0, 'holidayId': None}])
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual([result['status'] for result in response.json()['results']], ['skipped', 'forbidden', 'not_found'])
+        self.assertFalse(models.Transaction.objects.filter(tag__isnull=False).exists())
+
+    def test_malformed_batches_are_rejected_before_anything_is_loaded(self):
+        for updates in ([{'tagId': self.food.id}], ['transactionId'], {'transactionId': self.ids[0]},
+                        [{'transactionId': str(self.ids[0])}], [{'transactionId': [self.ids[0]]}],
+                        [{'transactionId': self.ids[0], 'tagId': str(self.food.id)}],
+                        [{'transactionId': self.ids[0], 'holidayId': {'id': 1}}], [{'transactionId': True}]):
+            with self.assertNumQueries(0):
+                self.assertEqual(self.post(updates).status_code, 400)
+
+
+class AssignHolidayTestCase(TestCase):
+
+    def setUp(self):
+        response_cache.cache.clear()
+        self.user = models.User.objects.create_user('assign', None, 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        self.food = models.Tag.objects.create(name='Eating Out')
+        self.holiday = models.Holiday.objects.create(name='Trip', user=self.user, start_date=datetime.date(2023, 1, 30),
+                                                     end_date=datetime.date(2023, 2, 5))
+        self.current = create_account(self.user, 'Current')
+        self.card = create_account(self.user, 'Card')
+        self.current.save_transactions([booked_transaction(f'c{day}', -10, f'2023-01-{day}') for day in (29, 30, 31)])
+        self.card.save_transactions([booked_transaction(f'k{day}', -5, f'2023-02-0{day}') for day in (1, 5, 6)])
+        models.Transaction.objects.filter(internal_transaction_id='k5').update(tag=self.food)
+
+    def assign(self, **data):
+        return self.client.post('/holidays/assign', dict(data, holidayId=self.holiday.id), format='json')
+
+    def on_holiday(self):
+        return set(models.Transaction.objects.filter(holiday=self.holiday).values_list('internal_transaction_id', flat=True))
+
+    def test_assigns_every_transaction_in_the_window(self):
+        self.assertEqual(self.client.get('/holidays').json()['holidays'][0]['holidays'][0]['total'], 0)
+
+        response = self.assign()
+
+        self.assertEqual(response.json(), {'holidayId': self.holiday.id, 'matched': 4, 'updated': 4, 'reassigned': 0})
+        self.assertEqual(self.on_holiday(), {'c30', 'c31', 'k1', 'k5'})
+        self.assertEqual(self.client.get('/holidays').json()['holidays'][0]['holidays'][0]['total'], -30)
+        self.assertEqual(self.assign().json()['updated'], 0)
+
+    def test_filters_and_clear(self):
+        self.assertEqual(self.assign(accountIds=[self.card.id]).json()['updated'], 2)
+        self.assertEqual(self.on_holiday(), {'k1', 'k5'})
+
+        self.assertEqual(self.assign(clear=True, tagIds=[self.food.id]).json()['updated'], 1)
+        self.assertEqual(self.on_holiday(), {'k1'})
+
+        self.assertEqual(self.assign(currency='EUR').json()['updated'], 0)
+
+    def test_other_holidays_are_only_overwritten_when_asked(self):
+        ski = models.Holiday.objects.create(name='Ski', user=self.user, start_date=datetime.date(2023, 2, 1),
+                                            end_date=datetime.date(2023, 2, 1))
+        models.Transaction.objects.filter(internal_transaction_id='k1').update(holiday=ski)
+        version = models.UserDataVersion.current(self.user.id)
+
+        self.assertEqual(self.assign(tagIds=[self.food.id], accountIds=[self.current.id]).json()['updated'], 0)
+        self.assertEqual(models.UserDataVersion.current(self.user.id), version)
+
+        self.assertEqual(self.assign().json(), {'holidayId': self.holiday.id, 'matched': 4, 'updated': 3, 'reassigned': 0})
+        self.assertEqual(self.on_holiday(), {'c30', 'c31', 'k5'})
+
+        self.assertEqual(self.assign(overwrite=True).json(), {'holidayId': self.holiday.id, 'matched': 4, 'updated': 1, 'reassigned': 1})
+        self.assertEqual(self.on_holiday(), {'c30', 'c31', 'k1', 'k5'})
+
+    def test_flags_must_be_booleans(self):
+        for flags in ({'clear': 'false'}, {'overwrite': 1}, {'clear': None}):
+            self.assertEqual(self.assign(**flags).status_code, 400)
+        self.assertEqual(self.on_holiday(), set())
+
+    def test_filters_must_be_lists_of_ids_and_a_currency_code(self):
+        for filters in ({'accountIds': str(self.card.id)}, {'accountIds': [str(self.card.id)]}, {'tagIds': [True]},
+                        {'tagIds': {'id': self.food.id}}, {'currency': ['EUR']}):
+            self.assertEqual(self.assign(**filters).status_code, 400)
+        self.assertEqual(self.client.post('/holidays/assign', {'holidayId': 'trip'}, format='json').status_code, 400)
+        self.assertEqual(self.on_holiday(), set())
+
+    def test_other_users_holidays_are_rejected(self):
+        other = models.User.objects.create_user('assignother', None, 'password')
+        self.holiday.user = other
+        self.holiday.save()
 
-# Create your tests here.
+        self.assertEqual(self.assign().status_code, 403)
+        self.assertEqual(self.on_holiday(), set())
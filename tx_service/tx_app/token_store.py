@@ -0,0 +1,199 @@
+import datetime
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+# Long enough for a token request including its connect retries, so a lease
+# only runs out when its holder has died.
+LOCK_TIMEOUT_SECONDS = 120
+LOCK_POLL_SECONDS = 0.1
+
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class Token:
+    def __init__(self, token: str, expires_in_seconds: int = None, expires: datetime.datetime = None):
+        self.token = token
+        self.expires = expires if expires is not None else utc_now() + datetime.timedelta(seconds=expires_in_seconds)
+
+    def is_valid(self):
+        if utc_now() > self.expires:
+            return False
+        else:
+            return True
+
+    def expires_within(self, seconds):
+        return utc_now() + datetime.timedelta(seconds=seconds) > self.expires
+
+    def __repr__(self):
+        return self.token
+
+    def __str__(self):
+        return self.token
+
+
+class TokenLockTimeout(Exception):
+    pass
+
+
+class TokenStore(ABC):
+    @abstractmethod
+    def load(self):
+        pass
+
+    @abstractmethod
+    def save(self, access_token: Token, refresh_token: Token):
+        pass
+
+    @abstractmethod
+    def lock(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryTokenStore(TokenStore):
+    def __init__(self):
+        self._access_token = None
+        self._refresh_token = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        return self._access_token, self._refresh_token
+
+    def save(self, access_token, refresh_token):
+        self._access_token, self._refresh_token = access_token, refresh_token
+
+    @contextmanager
+    def lock(self):
+        with self._lock:
+            yield
+
+
+class LeaseTokenStore(TokenStore):
+    # The lock shared between processes is a lease tagged with its owner, so
+    # a holder that dies frees it after LOCK_TIMEOUT_SECONDS, and a holder
+    # whose lease ran out cannot release one taken over by someone else.
+    def __init__(self):
+        self._local_lock = threading.Lock()
+
+    @abstractmethod
+    def acquire(self, owner):
+        pass
+
+    @abstractmethod
+    def release(self, owner):
+        pass
+
+    @contextmanager
+    def lock(self):
+        owner = uuid.uuid4().hex
+        with self._local_lock:
+            deadline = time.monotonic() + LOCK_TIMEOUT_SECONDS
+            while not self.acquire(owner):
+                if time.monotonic() >= deadline:
+                    raise TokenLockTimeout(f"Token lock not acquired within {LOCK_TIMEOUT_SECONDS}s")
+                time.sleep(LOCK_POLL_SECONDS)
+
+            try:
+                yield
+            finally:
+                self.release(owner)
+
+
+class CacheTokenStore(LeaseTokenStore):
+    key = "nordigen:tokens"
+    lock_key = "nordigen:tokens:lock"
+
+    def load(self):
+        data = cache.get(self.key)
+        if data is None:
+            return None, None
+
+        return Token(data['access'], expires=data['access_expires']), Token(data['refresh'], expires=data['refresh_expires'])
+
+    def save(self, access_token, refresh_token):
+        data = {
+            'access': access_token.token,
+            'access_expires': access_token.expires,
+            'refresh': refresh_token.token,
+            'refresh_expires': refresh_token.expires,
+        }
+        timeout = max((refresh_token.expires - utc_now()).total_seconds(), 1)
+        cache.set(self.key, data, timeout)
+
+    def acquire(self, owner):
+        return cache.add(self.lock_key, owner, LOCK_TIMEOUT_SECONDS)
+
+    def release(self, owner):
+        # The cache API has no compare-and-delete, so a lease expiring
+        # between these two calls can still be released; the lease timeout
+        # keeps that to holders that overran it.
+        if cache.get(self.lock_key) == owner:
+            cache.delete(self.lock_key)
+
+
+class DatabaseTokenStore(LeaseTokenStore):
+    name = "nordigen"
+
+    def load(self):
+        from tx_app.models import ProviderToken
+
+        row = ProviderToken.objects.filter(name=self.name).first()
+        if row is None or row.access_token is None:
+            return None, None
+
+        return Token(row.access_token, expires=row.access_expires), Token(row.refresh_token, expires=row.refresh_expires)
+
+    def save(self, access_token, refresh_token):
+        from tx_app.models import ProviderToken
+
+        ProviderToken.objects.update_or_create(name=self.name, defaults={
+            'access_token': access_token.token,
+            'access_expires': access_token.expires,
+            'refresh_token': refresh_token.token,
+            'refresh_expires': refresh_token.expires,
+        })
+
+    def acquire(self, owner):
+        # Each step is a single statement, so no transaction stays open
+        # while the tokens are requested from Nordigen.
+        from django.db.models import Q
+        from tx_app.models import ProviderToken
+
+        now = utc_now()
+        ProviderToken.objects.get_or_create(name=self.name)
+        return bool(ProviderToken.objects
+                    .filter(Q(lock_expires__isnull=True) | Q(lock_expires__lt=now), name=self.name)
+                    .update(lock_owner=owner, lock_expires=now + datetime.timedelta(seconds=LOCK_TIMEOUT_SECONDS)))
+
+    def release(self, owner):
+        from tx_app.models import ProviderToken
+
+        ProviderToken.objects.filter(name=self.name, lock_owner=owner).update(lock_owner=None, lock_expires=None)
+
+    def close(self):
+        from django.db import connection
+
+        connection.close()
+
+
+TOKEN_STORES = {
+    'memory': MemoryTokenStore,
+    'cache': CacheTokenStore,
+    'database': DatabaseTokenStore,
+}
+
+
+def create_token_store(backend):
+    try:
+        return TOKEN_STORES[backend]()
+    except KeyError:
+        raise ValueError(f"Unknown token store: {backend}, expected one of {', '.join(TOKEN_STORES)}")
@@ -15,8 +15,12 @@ urlpatterns = [
    path('requisition', Requisition.as_view()),
    path('tags', Tags.as_view()),
    path('rules', TagRules.as_view()),
+   path('rules/jobs/<int:job_id>', TagRuleJobs.as_view()),
    path('reports', Reports.as_view()),
    path('holidays', Holidays.as_view()),
+   path('holidays/assign', AssignHoliday.as_view()),
+   path('changes', Changes.as_view()),
+   path('cache/stats', ResponseCacheStats.as_view()),
 
    path('private/upload/transactions', UploadTransactions.as_view()),
    path('private/update/institutions', UpdateInstitutions.as_view()),
@@ -1,15 +1,26 @@
 import datetime
-import logging
 
+from asgiref.sync import async_to_sync
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from rest_framework.views import APIView
 from rest_framework.views import Response
 from rest_framework.exceptions import bad_request, ValidationError
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.authtoken.models import Token
 import tx_app.nordigen as nordigen
+import tx_app.nordigen_async as nordigen_async
+import tx_app.pagination as pagination
 import tx_app.TransactionHelper as TransactionHelper
+import tx_app.analytics as analytics
+import tx_app.changes as changes
+import tx_app.fast_serialize as fast_serialize
+import tx_app.holiday_summary as holiday_summary
+import tx_app.tagging as tagging
+import tx_app.tag_tree as tag_tree
+import tx_app.bulk_update as bulk_update
+import tx_app.reports as reports
+import tx_app.response_cache as response_cache
 from datetime import timedelta
 
 import tx_app.Serialize as serialize
@@ -21,13 +32,13 @@ MIN_PASSWORD_LENGTH = 5
 # Create your views here.
 
 
-def validate_ownership(resource, requesting_user):
-    if resource.user is not None and resource.user != requesting_user:
-        error = f"Resource {resource} does not belong to user"
-        logging.log(logging.ERROR, error)
-        return False, Response(status=403, data={'error': error})
-    else:
-        return True, None
+def is_id(value):
+    # JSON true and false decode to bools, which are ints in Python.
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_id_list(value):
+    return isinstance(value, list) and all(is_id(item) for item in value)
 
 
 class CreateUser(APIView):
@@ -78,27 +89,34 @@ class UpdateAccounts(APIView):
 
         user = request.user
 
-        requisitions = models.Requisition.objects.filter(user=user, status__exact='ACTIVE')
+        requisitions = models.Requisition.objects.filter(user=user, status__exact='ACTIVE').select_related('institution')
 
+        active_requisitions = []
         for requisition in requisitions:
             if requisition.expires > datetime.date.today():
-                link = nordigen.get_requisition(requisition.external_id)
-                for account_id in link.accounts:
-                    account_details = nordigen.get_account(account_id)
-                    account, created = models.Account.objects.get_or_create(
-                        resource_id=account_id, user=user, institution=requisition.institution)
-
-                    if account.name is None:
-                        account.name = requisition.institution.name
-                    account.account_name = account_details.owner_name
-                    account.iban = account_details.iban
-                    account.bban = account_details.bban
-                    account.requisition = requisition
-                    account.save()
+                active_requisitions.append(requisition)
             else:
                 requisition.status = 'EXPIRED'
                 requisition.save()
 
+        linked_accounts = async_to_sync(nordigen_async.get_linked_accounts)(
+            [requisition.external_id for requisition in active_requisitions])
+
+        for requisition in active_requisitions:
+            for account_id, account_details in linked_accounts.get(requisition.external_id, []):
+                account, created = models.Account.objects.get_or_create(
+                    resource_id=account_id, user=user, institution=requisition.institution)
+
+                if account.name is None:
+                    account.name = requisition.institution.name
+                account.account_name = account_details.owner_name
+                account.iban = account_details.iban
+                account.bban = account_details.bban
+                account.requisition = requisition
+                account.save()
+
+        models.UserDataVersion.bump(user.id)
+
         return Response(status=200)
 
 
@@ -106,6 +124,25 @@ class Transactions(APIView):
     permission_classes = (IsAuthenticated,)
 
     def get(self, request):
+        if request.query_params.get('stream') == '1':
+            return StreamingHttpResponse(fast_serialize.stream_transactions(request.user), content_type='application/json')
+
+        if pagination.wants_page(request.query_params):
+            try:
+                return response_cache.cached_json(
+                    request, lambda: pagination.transaction_page(request.user, request.query_params))
+            except pagination.PageError as error:
+                return Response(status=400, data={"error": str(error)})
+
+        return response_cache.cached_json(request, lambda: self.build(request), dated=True)
+
+    def build(self, request):
+        if request.query_params.get('serializer') == 'legacy':
+            return self.build_legacy(request)
+
+        return fast_serialize.transactions(request.user)
+
+    def build_legacy(self, request):
         user = request.user
 
         accounts = models.Account.objects.filter(user=user)
@@ -113,27 +150,12 @@ class Transactions(APIView):
         institution_ids = [account.institution.id for account in accounts]
         institutions = [models.Institution.objects.get(id=id) for id in institution_ids]
 
-        transactions = {account.id: models.Transaction.objects.filter(account=account) for account in accounts}
+        transactions = {account.id: models.Transaction.objects.filter(account=account).order_by('-booking_date_time', '-id')
+                        for account in accounts}
 
-        links = models.TransactionLink.objects.filter(from_transaction__account__user=user)
+        links = models.TransactionLink.objects.filter(from_transaction__account__user=user).order_by('id')
 
-        tags = list(models.Tag.objects.filter(user=None, parent=None)) + list(
-            models.Tag.objects.filter(user=user, parent=None))
-        sub_tags = []
-
-        for tag in tags:
-            sub_tags += list(models.Tag.objects.filter(parent=tag))
-
-        rules = models.TagRule.objects.filter(user=user)
-        for rule in rules:
-            for account in transactions:
-                for transaction in transactions[account]:
-                    if rule.expression.lower() in transaction.reference.lower():
-                        if transaction.tag is None:
-                            transaction.tag = rule.tag
-                            transaction.save()
-
-        return JsonResponse(data=serialize.transactions(accounts, transactions, institutions, links, tags, sub_tags))
+        return serialize.transactions(accounts, transactions, institutions, links, tag_tree.get(user))
 
     def post(self, request):
 
@@ -144,128 +166,54 @@ class Transactions(APIView):
         except KeyError as e:
             return Response(status=400, data={"error": str(e)})
 
-        for transaction_update in transaction_updates:
-            try:
-                transaction_id = transaction_update['transactionId']
-            except KeyError as e:
-                return Response(status=400, data={"error": str(e)})
-
-            transaction = models.Transaction.objects.get(id=transaction_id)
-
-            if 'tagId' in transaction_update:
-                tag_id = transaction_update['tagId']
-                tag = models.Tag.objects.get(id=tag_id) if tag_id is not None else None
-
-                valid, response = validate_ownership(tag, user)
-                if not valid:
-                    return response
-
-                transaction.tag = tag
-
-            if 'holidayId' in transaction_update:
-                holiday_id = transaction_update['holidayId']
-                holiday = models.Holiday.objects.get(id=holiday_id) if holiday_id is not None else None
-
-                valid, response = validate_ownership(holiday, user)
-                if not valid:
-                    return response
-
-                transaction.holiday = holiday
+        if not isinstance(transaction_updates, list):
+            return Response(status=400, data={"error": f"Expected a list of transactionUpdates: {transaction_updates}"})
 
-            models.Transaction.save(transaction)
-
-        return Response(status=200)
-
-def construct_empty_report(categories, tags, sub_tags):
-    report = {
-        "untagged": 0
-    }
-
-    for category in categories:
-        report[category.code] = {}
-        report[category.code]["total"] = 0
-        report[category.code]["categories"] = {}
+        for transaction_update in transaction_updates:
+            if not isinstance(transaction_update, dict) or 'transactionId' not in transaction_update:
+                return Response(status=400, data={"error": f"Missing transactionId: {transaction_update}"})
+            if not is_id(transaction_update['transactionId']):
+                return Response(status=400, data={"error": f"transactionId must be an integer: {transaction_update}"})
+            for name in ('tagId', 'holidayId'):
+                if transaction_update.get(name) is not None and not is_id(transaction_update[name]):
+                    return Response(status=400, data={"error": f"{name} must be an integer or null: {transaction_update}"})
 
-    for tag in tags:
-        if tag.category is not None:
-            report[tag.category.code]["categories"][tag.name] = {"tag": tag.serialize(), "total": 0, "categories": {}}
+        applied, results = bulk_update.apply_updates(user, transaction_updates)
 
-    for sub_tag in sub_tags:
-        parent = sub_tag.parent
-        if parent.category is not None:
-            report[parent.category.code]["categories"][parent.name]["categories"][sub_tag.name] = {"tag": sub_tag.serialize(), "total": 0}
+        if not applied:
+            forbidden = any(result['status'] == bulk_update.FORBIDDEN for result in results)
+            return Response(status=403 if forbidden else 404, data={"results": results})
 
-    return report
+        return Response(status=200, data={"results": results})
 
 
 class Reports(APIView):
     permission_classes = (IsAuthenticated,)
 
     def get(self, request):
-        reports = {}
+        return response_cache.cached_json(request, lambda: self.build(request))
 
+    def build(self, request):
         user = request.user
 
-        transactions = models.Transaction.getByUser(user)
-
-        tags = list(models.Tag.objects.filter(user=None, parent=None)) + list(
-            models.Tag.objects.filter(user=user, parent=None))
-        sub_tags = []
-
-        for tag in tags:
-            sub_tags += list(models.Tag.objects.filter(parent=tag))
-
-        categories = models.Category.objects.all()
-
-        def add_transaction_to_report(report, transaction):
-            if transaction.tag.category is None and transaction.tag.parent is not None:
-                report[transaction.tag.parent.category.code]["categories"][transaction.tag.parent.name]["categories"][transaction.tag.name]["total"] += transaction.amount
-                report[transaction.tag.parent.category.code]["categories"][transaction.tag.parent.name]["total"] += transaction.amount
-                report[transaction.tag.parent.category.code]["total"] += transaction.amount
-            elif transaction.tag.category is not None:
-                report[transaction.tag.category.code]["categories"][transaction.tag.name][
-                    "total"] += transaction.amount
-                report[transaction.tag.category.code]["total"] += transaction.amount
-
-        for transaction in transactions:
-            date: datetime = transaction.booking_date
-            month = date.strftime('%B')
-            if date.year not in reports.keys():
-                reports[date.year] = construct_empty_report(categories, tags, sub_tags)
-            if month not in reports[date.year].keys():
-                reports[date.year][month] = construct_empty_report(categories, tags, sub_tags)
-            if transaction.tag is None or transaction.holiday is not None:
-                if transaction.holiday is None and transaction.is_unlinked():
-                    reports[date.year][month]["untagged"] += 1
-                if transaction.account.type.code == "SAVINGS":
-                    reports[date.year][month]['SAVINGS']['total'] += transaction.amount
-                    reports[date.year]['SAVINGS']['total'] += transaction.amount
-            else:
-                add_transaction_to_report(reports[date.year][month], transaction)
-                add_transaction_to_report(reports[date.year], transaction)
+        if request.query_params.get('source') == 'live':
+            report = reports.live_report(user)
+        elif request.query_params.get('source') == 'columnar':
+            report = analytics.columnar_report(user)
+        else:
+            report = reports.rollup_report(user)
 
-        return JsonResponse(status=200, data=reports)
+        return report
 
 
 class Tags(APIView):
     permission_classes = (IsAuthenticated,)
 
     def get(self, request):
+        return response_cache.cached_json(request, lambda: self.build(request))
 
-        user = request.user
-
-        tags = list(models.Tag.objects.filter(user=None, parent=None)) + list(
-            models.Tag.objects.filter(user=user, parent=None))
-        sub_tags = []
-
-        for tag in tags:
-            sub_tags += list(models.Tag.objects.filter(parent=tag))
-
-        rules = models.TagRule.objects.filter(user=user)
-
-        categories = models.Category.objects.all()
-
-        return JsonResponse(data=serialize.tags(tags, sub_tags, rules, categories))
+    def build(self, request):
+        return serialize.tags(tag_tree.get(request.user))
 
     def put(self, request):
         user = request.user
@@ -288,6 +236,7 @@ class Tags(APIView):
             tag.parent = parentTag
 
         tag.save()
+        changes.record(user.id, models.ChangeEvent.TAG, [tag.id])
 
         return Response(status=201)
 
@@ -318,6 +267,15 @@ class Tags(APIView):
 
         tag.save()
 
+        if 'categoryCode' in request.data:
+            reports.recategorise([tag.id])
+
+        # Global tags show up for every user.
+        if tag.user is None:
+            changes.record_all(models.ChangeEvent.TAG, [tag.id])
+        else:
+            changes.record(user.id, models.ChangeEvent.TAG, [tag.id])
+
         return Response(status=201)
 
 
@@ -381,6 +339,7 @@ class Requisition(APIView):
 
         if success:
             requisition.delete()
+            models.UserDataVersion.bump(requisition.user_id)
             return Response(status=200)
         else:
             return Response(status=500)
@@ -396,6 +355,7 @@ class Requisition(APIView):
 
         requisition.status = status
         requisition.save()
+        models.UserDataVersion.bump(requisition.user_id)
 
         return Response(status=200)
 
@@ -409,14 +369,15 @@ class UploadTransactions(APIView):
         request_transactions = data['transactions']
         booked_transactions = request_transactions['booked']
 
-        account.save_transactions(booked_transactions)
+        result = account.save_transactions(booked_transactions)
 
-        return Response(status=200)
+        return Response(status=200, data=result.serialize())
 
 
 class UploadTags(APIView):
     def post(self, request):
         data = request.data
+        tag_ids = []
         try:
             tags = data['tags']
 
@@ -426,6 +387,7 @@ class UploadTags(APIView):
                 tag_object.icon = tag['icon']
                 tag_object.user = None
                 models.Tag.save(tag_object)
+                tag_ids.append(tag_object.id)
 
                 for child in tag['childTags']:
                     sub_tag, created = models.Tag.objects.get_or_create(name=child['name'])
@@ -434,9 +396,14 @@ class UploadTags(APIView):
                     sub_tag.parent = tag_object
                     sub_tag.user = None
                     models.Tag.save(sub_tag)
+                    tag_ids.append(sub_tag.id)
 
         except KeyError:
             return Response(status=400)
+        finally:
+            # Sub-tags may have moved to another parent, and so another category.
+            reports.recategorise(tag_ids)
+            changes.record_all(models.ChangeEvent.TAG, tag_ids)
 
         return Response(status=200)
 
@@ -452,12 +419,15 @@ class UpdateInstitutions(APIView):
             institution.code = institutionData.id
             institution.save()
 
+        # Every user's accounts show their bank's name and logo.
+        models.GlobalDataVersion.bump()
+
         return Response(status=200)
 
 
 class FindLinks(APIView):
     def get(self, request):
-        TransactionHelper.find_links(User.objects.get(id=9))
+        TransactionHelper.find_links(User.objects.get(id=9), window_days=0)
 
         return Response(status=200)
 
@@ -489,8 +459,11 @@ class TagRules(APIView):
         rule.expression = expression
 
         rule.save()
+        changes.record(user.id, models.ChangeEvent.RULE, [rule.id])
 
-        return Response(status=201)
+        job = tagging.enqueue_rule_job(user, rule.tag, rule.expression, models.TagRuleJob.APPLY)
+
+        return Response(status=201, data={"ruleId": rule.id, "jobId": job.id, "matched": job.matched})
 
     def delete(self, request):
         user = request.user
@@ -508,16 +481,113 @@ class TagRules(APIView):
             return JsonResponse(status=403, data={"error": "Unauthorised to edit this rule"})
 
         models.TagRule.delete(rule)
+        changes.record(user.id, models.ChangeEvent.RULE, [ruleId], deleted=True)
+
+        job = tagging.enqueue_rule_job(user, rule.tag, rule.expression, models.TagRuleJob.REMOVE)
+
+        return Response(status=200, data={"jobId": job.id, "matched": job.matched})
+
+
+class TagRuleJobs(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, job_id):
+        user = request.user
+
+        try:
+            job = models.TagRuleJob.objects.get(id=job_id, user=user)
+        except models.TagRuleJob.DoesNotExist:
+            return JsonResponse(status=404, data={"error": f"No rule job with id {job_id}"})
+
+        return JsonResponse(status=200, data=job.serialize())
+
+class Changes(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        user = request.user
+
+        if 'since' not in request.query_params:
+            sequence, global_sequence = models.UserDataVersion.current_with_global(user.id)
+            return JsonResponse(status=200, data={"sequence": sequence, "globalSequence": global_sequence})
+
+        # Global tag changes have their own sequence. Clients that do not send
+        # globalSince get every global tag change, which is safe to re-apply.
+        try:
+            since = int(request.query_params['since'])
+            global_since = int(request.query_params.get('globalSince', 0))
+        except ValueError:
+            return JsonResponse(status=400, data={"error": f"Invalid sequence: {request.query_params.urlencode()}"})
+
+        return JsonResponse(status=200, data=changes.changes_since(user, since, global_since))
+
+
+class ResponseCacheStats(APIView):
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return JsonResponse(status=200, data=response_cache.cache.stats())
 
-        return Response(status=200)
 
 class Holidays(APIView):
+    permission_classes = (IsAuthenticated,)
+
     def get(self, request):
+        return response_cache.cached_json(request, lambda: self.build(request))
+
+    def build(self, request):
+        user = request.user
+
+        holidays = list(models.Holiday.objects.filter(user=user))
+
+        if request.query_params.get('source') == 'columnar':
+            columns = analytics.TransactionColumns.for_user(user)
+            summaries = analytics.holiday_summaries(columns, [holiday.id for holiday in holidays])
+        else:
+            summaries = holiday_summary.summarise(user, holidays)
+
+        return {'holidays': serialize.holidays(holidays, summaries)}
+
+
+class AssignHoliday(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
         user = request.user
 
-        holidays = models.Holiday.objects.filter(user=user)
+        data = request.data
+
+        try:
+            holiday_id = data['holidayId']
+        except KeyError as e:
+            return JsonResponse(status=400, data={"error": str(e)})
+
+        if not is_id(holiday_id):
+            return JsonResponse(status=400, data={"error": f"holidayId must be an integer, got {holiday_id!r}"})
+
+        filters = {'account_ids': data.get('accountIds'), 'tag_ids': data.get('tagIds'), 'currency': data.get('currency')}
+        for name, value in (('accountIds', filters['account_ids']), ('tagIds', filters['tag_ids'])):
+            if value is not None and not is_id_list(value):
+                return JsonResponse(status=400, data={"error": f"{name} must be a list of integers, got {value!r}"})
+        if filters['currency'] is not None and not isinstance(filters['currency'], str):
+            return JsonResponse(status=400, data={"error": f"currency must be a string, got {filters['currency']!r}"})
+
+        try:
+            holiday = models.Holiday.objects.get(id=holiday_id)
+        except models.Holiday.DoesNotExist:
+            return JsonResponse(status=404, data={"error": f"No holiday with id {holiday_id}"})
+
+        if holiday.user_id != user.id:
+            return JsonResponse(status=403, data={"error": "Unauthorised to edit this holiday"})
+
+        flags = {name: data.get(name, False) for name in ('clear', 'overwrite')}
+        for name, value in flags.items():
+            if not isinstance(value, bool):
+                return JsonResponse(status=400, data={"error": f"{name} must be true or false, got {value!r}"})
+
+        result = bulk_update.assign_holiday(user, holiday, **filters, **flags)
 
-        return JsonResponse(data={'holidays': serialize.holidays(holidays)})
+        return JsonResponse(status=200, data=result)
 
 
 
@@ -156,6 +156,15 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Spend categories summarised per holiday, see tx_app/holiday_summary.py.
+HOLIDAY_SUMMARY_BUCKETS = {
+    'travel': {'parent': 'Travel', 'exclude': ['Hotels']},
+    'hotels': {'tags': ['Hotels']},
+    'food': {'tags': ['Eating Out']},
+}
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,